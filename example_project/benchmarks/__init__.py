@@ -0,0 +1,27 @@
+"""
+Micro-benchmarks for sky_visitor. Run them from the example_project directory, for example:
+
+    python -m benchmarks.template_senders
+"""
+import os
+import sys
+import timeit
+
+
+def setup():
+    proj_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    if proj_dir not in sys.path:
+        sys.path.insert(0, proj_dir)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "normal_tests.settings")
+
+    import django
+    django.setup()
+
+
+def bench(label, func, number=1000, repeat=3):
+    """
+    Print the best per-call time of `func` over `repeat` runs of `number` calls. Returns it in seconds.
+    """
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    print "%-50s %10.1f us/op" % (label, best * 1e6)
+    return best
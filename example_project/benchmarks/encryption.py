@@ -0,0 +1,51 @@
+"""
+Per-operation cost of sky_visitor.utils.Encryption: the original pickle+hex format with the key derived for every
+value, the current format with the key derived for every value, and the current format with the derived key cached.
+"""
+from benchmarks import setup, bench
+
+setup()
+
+import binascii
+import cPickle as pickle
+from Crypto.Cipher import AES
+
+from sky_visitor.utils import Encryption
+
+
+class UncachedKeyEncryption(Encryption):
+    # Derives the key for every value, as Encryption did before the key cache
+    def get_cipher_instance(self):
+        key = self.build_key(self.key)
+        return AES.new(key, AES.MODE_CBC, key[:16])
+
+
+class OriginalEncryption(UncachedKeyEncryption):
+    # How Encryption worked before the storage format changed
+    def decrypt(self, enc_message):
+        ciphertext = binascii.a2b_hex(enc_message)
+        return pickle.loads(self.get_cipher_instance().decrypt(ciphertext).rstrip(' '))
+
+    def encrypt(self, message):
+        pickled = pickle.dumps(message)
+        ciphertext = self.get_cipher_instance().encrypt(pickled + (' ' * (16 - (len(pickled) % 16))))
+        return binascii.b2a_hex(ciphertext)
+
+
+def main():
+    key = 'invited@example.com_secret'
+    passwords = ['password%d' % i for i in range(100)]
+    encrypted = Encryption(key).encrypt_many(passwords)
+
+    for label, encrypter in (("original format, uncached key", OriginalEncryption(key)),
+                             ("current format, uncached key", UncachedKeyEncryption(key)),
+                             ("current format, cached key", Encryption(key))):
+        enc_password = encrypter.encrypt('password')
+        bench("encrypt, %s" % label, lambda: encrypter.encrypt('password'), number=10000)
+        bench("decrypt, %s" % label, lambda: encrypter.decrypt(enc_password), number=10000)
+    bench("encrypt_many, 100 messages", lambda: Encryption(key).encrypt_many(passwords), number=100)
+    bench("decrypt_many, 100 messages", lambda: Encryption(key).decrypt_many(encrypted), number=100)
+
+
+if __name__ == '__main__':
+    main()
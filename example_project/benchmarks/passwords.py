@@ -0,0 +1,27 @@
+"""
+Throughput of sky_visitor.utils.make_passwords compared to generating passwords one character at a time with
+random.choice, the way make_password used to.
+"""
+from benchmarks import setup, bench
+
+setup()
+
+import random
+import string
+
+from sky_visitor.utils import make_passwords
+
+
+def random_choice_passwords(n, length=8, chars=string.ascii_letters):
+    return [''.join(random.choice(chars) for _ in xrange(length)) for _ in xrange(n)]
+
+
+def main():
+    n = 100000
+    before = bench("random.choice, %d passwords" % n, lambda: random_choice_passwords(n), number=1)
+    after = bench("make_passwords, %d passwords" % n, lambda: list(make_passwords(n)), number=1)
+    print "%.0f vs %.0f passwords/s (%.1fx)" % (n / before, n / after, before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Throughput of the template senders delivering over real SMTP, against an in-process mail server.
+
+The stand-in server answers instantly and handles one command at a time, so a remote relay's round trips make the
+gap between connecting per message and keeping connections open larger than shown here.
+"""
+import time
+
+from benchmarks import setup
+
+setup()
+
+from django.conf import settings
+from sky_visitor.template_email_senders import AsyncTemplateSender, DjangoTemplateSender, SMTPPool
+from sky_visitor.tests import LocalSMTPServer
+
+MESSAGES = 200
+
+
+def throughput(label, send):
+    start = time.time()
+    send()
+    elapsed = time.time() - start
+    print "%-50s %10.0f msg/s" % (label, MESSAGES / elapsed)
+
+
+def main():
+    settings.DEBUG = False
+    server = LocalSMTPServer().start()
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    settings.EMAIL_HOST = '127.0.0.1'
+    settings.EMAIL_PORT = server.port
+    messages = [{
+        'template_name': 'sky_visitor/email/invitation_complete.html',
+        'to_address': 'user%d@example.com' % i,
+        'subject': 'Invitation to Create Account',
+        'context': {'token_url': 'http://testserver/user/invitation/%d-abc-123/' % i},
+    } for i in range(MESSAGES)]
+
+    try:
+        sender = DjangoTemplateSender()
+        throughput("DjangoTemplateSender.send(), one by one", lambda: [sender.send(**kwargs) for kwargs in messages])
+        throughput("DjangoTemplateSender.send_many()", lambda: sender.send_many(messages))
+        for size in (1, 4):
+            pool = SMTPPool(size)
+            sender = AsyncTemplateSender(pool=pool)
+            throughput("AsyncTemplateSender.send_many(), %d connections" % size, lambda: sender.send_many(messages))
+            pool.close()
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
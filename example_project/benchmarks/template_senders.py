@@ -0,0 +1,39 @@
+"""
+Compare how long DjangoTemplateSender and Jinja2TemplateSender take to build a token email.
+"""
+from benchmarks import setup, bench
+
+setup()
+
+from django.conf import settings
+from sky_visitor.template_email_senders import DjangoTemplateSender, Jinja2TemplateSender, jinja2
+
+
+def main():
+    # The template caches are bypassed in DEBUG
+    settings.DEBUG = False
+    kwargs = {
+        'template_name': 'sky_visitor/email/invitation_complete.html',
+        'text_template_name': 'sky_visitor/email/invitation_complete.txt',
+        'to_address': 'user@example.com',
+        'subject': 'Invitation to Create Account at {{ site_name }}',
+        'context': {'token_url': 'http://testserver/user/invitation/1-abc-123/', 'site_name': 'testserver'},
+    }
+    senders = [DjangoTemplateSender]
+    if jinja2 is not None:
+        senders.append(Jinja2TemplateSender)
+    else:
+        print "Jinja2 is not installed, skipping Jinja2TemplateSender"
+
+    results = {}
+    for sender_class in senders:
+        sender = sender_class()
+        results[sender_class] = bench("%s.build_message()" % sender_class.__name__,
+                                      lambda: sender.build_message(**kwargs))
+    if len(results) == 2:
+        print "Jinja2TemplateSender is %.1fx the speed of DjangoTemplateSender" % (
+            results[DjangoTemplateSender] / results[Jinja2TemplateSender])
+
+
+if __name__ == '__main__':
+    main()
@@ -43,6 +43,19 @@ TESTS_TO_RUN = [
     'customuser_tests.ForgotPasswordProcessTest',
     'customuser_tests.ChangePasswordViewTest',
     'customuser_tests.InvitationProcessTest',
+    'customuser_tests.BulkInvitationTest',
+    'customuser_tests.EmailOutboxTest',
+    'customuser_tests.TemplateSenderTest',
+    'customuser_tests.EncryptionTest',
+    'customuser_tests.MakePasswordsTest',
+    'customuser_tests.SignedTokenGeneratorTest',
+    'customuser_tests.EmailBackendTest',
+    'customuser_tests.CachedUserBackendTest',
+    'customuser_tests.HashingExecutorTest',
+    'customuser_tests.CalibrateHasherTest',
+    'customuser_tests.LastLoginWriteBehindTest',
+    'customuser_tests.PageCacheTest',
+    'customuser_tests.AsyncTemplateSenderTest',
 ]
 
 DATABASES = {
@@ -69,4 +69,56 @@ class ChangePasswordViewTest(normaltests.ChangePasswordViewTest):
 
 
 class InvitationProcessTest(RegisterUserMixin, normaltests.InvitationProcessTest):
-    pass
\ No newline at end of file
+    pass
+
+
+class BulkInvitationTest(normaltests.BulkInvitationTest):
+    pass
+
+
+class EmailOutboxTest(normaltests.EmailOutboxTest):
+    pass
+
+
+class TemplateSenderTest(normaltests.TemplateSenderTest):
+    pass
+
+
+class EncryptionTest(normaltests.EncryptionTest):
+    pass
+
+
+class MakePasswordsTest(normaltests.MakePasswordsTest):
+    pass
+
+
+class SignedTokenGeneratorTest(normaltests.SignedTokenGeneratorTest):
+    pass
+
+
+class EmailBackendTest(normaltests.EmailBackendTest):
+    pass
+
+
+class CachedUserBackendTest(normaltests.CachedUserBackendTest):
+    pass
+
+
+class HashingExecutorTest(normaltests.HashingExecutorTest):
+    pass
+
+
+class CalibrateHasherTest(normaltests.CalibrateHasherTest):
+    pass
+
+
+class LastLoginWriteBehindTest(normaltests.LastLoginWriteBehindTest):
+    pass
+
+
+class PageCacheTest(normaltests.PageCacheTest):
+    pass
+
+
+class AsyncTemplateSenderTest(normaltests.AsyncTemplateSenderTest):
+    pass
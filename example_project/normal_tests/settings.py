@@ -49,6 +49,20 @@ TESTS_TO_RUN = [
     'normal_tests.ForgotPasswordProcessTest',
     'normal_tests.ChangePasswordViewTest',
     'normal_tests.InvitationProcessTest',
+    'normal_tests.BulkInvitationTest',
+    'normal_tests.EmailOutboxTest',
+    'normal_tests.TemplateSenderTest',
+    'normal_tests.EncryptionTest',
+    'normal_tests.MakePasswordsTest',
+    'normal_tests.SignedTokenGeneratorTest',
+    'normal_tests.EmailBackendTest',
+    'normal_tests.CachedUserBackendTest',
+    'normal_tests.PermissionCacheTest',
+    'normal_tests.HashingExecutorTest',
+    'normal_tests.CalibrateHasherTest',
+    'normal_tests.LastLoginWriteBehindTest',
+    'normal_tests.PageCacheTest',
+    'normal_tests.AsyncTemplateSenderTest',
 ]
 
 DATABASES = {
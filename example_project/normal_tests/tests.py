@@ -11,17 +11,47 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import binascii
+import datetime
+import re
+import smtplib
+import cPickle as pickle
+import time
+from importlib import import_module
 from django.conf import settings
-from django.contrib.auth import get_user_model, SESSION_KEY
+from django.contrib.auth import get_user_model, BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import Group, Permission
 from django.contrib.auth.forms import SetPasswordForm
 from django.contrib.auth.tokens import default_token_generator
+from django.contrib.messages.storage.cookie import CookieStorage
 from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends import locmem
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.test import Client, RequestFactory, override_settings
+from django.template import loader
+from django.utils import timezone
 from django.utils.http import int_to_base36
+from django.utils.six import StringIO
 from django.utils.text import capfirst
-from sky_visitor.models import InvitedUser
+from unittest import skipIf
+from mock import patch
+from sky_visitor.models import InvitedUser, EmailOutbox
 from sky_visitor.forms import InvitationCompleteForm
-from sky_visitor.tests import SkyVisitorTestCase
+from sky_visitor.backends import BaseBackend, CachedUserBackend, EmailBackend, auto_login
+from sky_visitor.cache import get_cache
+from sky_visitor import hashing
+from sky_visitor.hashing import HashingExecutor, HashingUnavailable
+from sky_visitor import last_login
+from sky_visitor.utils import Encryption, make_passwords
+from sky_visitor.template_email_senders import AsyncTemplateSender, BaseTemplateSender, DjangoTemplateSender, \
+    Jinja2TemplateSender, SMTPPool, jinja2
+from sky_visitor.tokens import SignedTokenGenerator, invitation_token_generator
+from sky_visitor.views import ForgotPasswordView, ResetPasswordView, LoginView
+from sky_visitor.views.mixins import PageCacheMixin, StaticPageMixin, get_invalid_token_cache_stats
+from sky_visitor.tests import LocalSMTPServer, SkyVisitorTestCase
 
 
 FIXTURE_USER_DATA = {
@@ -113,6 +143,48 @@ class LoginViewTest(SkyVisitorViewsTestCase):
         user = UserModel._default_manager.get(**{UserModel.USERNAME_FIELD: FIXTURE_USER_DATA[UserModel.USERNAME_FIELD]})
         self.assertLoggedIn(user, backend='django.contrib.auth.backends.ModelBackend')
 
+    def test_signed_test_cookie_writes_no_session(self):
+        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+        data = {'username': FIXTURE_USER_DATA[get_user_model().USERNAME_FIELD], 'password': 'wrong'}
+        with patch.object(LoginView, 'test_cookie', 'signed'), patch.object(SessionStore, 'save') as save:
+            response = self.client.get(self.view_url)
+            self.assertIn(LoginView.test_cookie_name, response.cookies)
+            self.assertEqual(self.client.post(self.view_url, data).status_code, 200)
+            self.assertEqual(save.call_count, 0)
+
+            data['password'] = FIXTURE_USER_DATA['password']
+            response = self.client.post(self.view_url, data)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.cookies[LoginView.test_cookie_name].value, '')
+            self.assertTrue(save.called)
+
+    def test_session_test_cookie_writes_session(self):
+        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+        with patch.object(SessionStore, 'save') as save:
+            self.client.get(self.view_url)
+            self.assertTrue(save.called)
+
+    def test_should_rate_limit_per_ip(self):
+        get_cache().clear()
+        data = {'username': 'nobody', 'password': 'wrong'}
+        with patch.object(LoginView, 'rate_limit_per_ip', (2, 60)):
+            for i in range(2):
+                self.assertEqual(self.client.post(self.view_url, data).status_code, 200)
+            with self.assertNumQueries(0):
+                response = self.client.post(self.view_url, data)
+            self.assertEqual(response.status_code, 429)
+            # Other clients aren't affected
+            self.assertEqual(self.client.post(self.view_url, data, REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_should_rate_limit_per_username(self):
+        get_cache().clear()
+        data = {'username': 'Nobody', 'password': 'wrong'}
+        with patch.object(LoginView, 'rate_limit_per_user', (2, 60)):
+            for i in range(2):
+                self.assertEqual(self.client.post(self.view_url, data, REMOTE_ADDR='10.0.0.%d' % i).status_code, 200)
+            data['username'] = ' nobody'
+            self.assertEqual(self.client.post(self.view_url, data, REMOTE_ADDR='10.0.0.9').status_code, 429)
+
     def test_should_have_username_field(self):
         response = self.client.get(self.view_url)
         self.assertEqual(response.status_code, 200)
@@ -122,6 +194,341 @@ class LoginViewTest(SkyVisitorViewsTestCase):
         self.assertEqual(form.fields['username'].label, capfirst(username_field.verbose_name))
 
 
+class EmailBackendTest(SkyVisitorViewsTestCase):
+
+    def test_authenticate_by_email(self):
+        backend = EmailBackend()
+        email = FIXTURE_USER_DATA['email'].upper()
+        self.assertEqual(backend.authenticate(email=email, password=FIXTURE_USER_DATA['password']), self.default_user)
+        self.assertEqual(backend.authenticate(username=email, password=FIXTURE_USER_DATA['password']),
+                         self.default_user)
+        self.assertIsNone(backend.authenticate(email=email, password='wrong'))
+        self.assertIsNone(backend.authenticate(email='nobody@example.com', password=FIXTURE_USER_DATA['password']))
+
+    def test_authenticate_checks_user_can_authenticate(self):
+        backend = EmailBackend()
+        with patch.object(EmailBackend, 'user_can_authenticate', create=True, return_value=False):
+            self.assertIsNone(backend.authenticate(email=FIXTURE_USER_DATA['email'],
+                                                   password=FIXTURE_USER_DATA['password']))
+
+
+class CachedUserBackendTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        super(CachedUserBackendTest, self).setUp()
+        get_cache().clear()
+
+    def test_get_user_is_cached(self):
+        backend = CachedUserBackend()
+        self.assertEqual(backend.get_user(self.default_user.pk), self.default_user)
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.get_user(self.default_user.pk), self.default_user)
+
+    def test_save_and_delete_invalidate(self):
+        backend = CachedUserBackend()
+        user = backend.get_user(self.default_user.pk)
+        user.email = 'changed@example.com'
+        user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.get_user(user.pk).email, 'changed@example.com')
+        user.delete()
+        self.assertIsNone(backend.get_user(user.pk))
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend',
+                                                'sky_visitor.backends.CachedUserBackend'])
+    def test_auto_login_keeps_configured_backend(self):
+        request = RequestFactory().get('/')
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        auto_login(request, self.default_user)
+        self.assertEqual(request.session[BACKEND_SESSION_KEY], 'sky_visitor.backends.CachedUserBackend')
+
+    def test_change_password_invalidates(self):
+        backend = CachedUserBackend()
+        self.login()
+        backend.get_user(self.default_user.pk)
+        self.client.post('/user/change_password/', {
+            'old_password': FIXTURE_USER_DATA['password'],
+            'new_password1': 'newpassword',
+            'new_password2': 'newpassword',
+        })
+        self.assertTrue(backend.get_user(self.default_user.pk).check_password('newpassword'))
+
+
+@patch.object(BaseBackend, 'permission_cache_timeout', 60)
+class PermissionCacheTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        super(PermissionCacheTest, self).setUp()
+        get_cache().clear()
+        self.permission = Permission.objects.get(codename='add_group')
+        self.perm_name = 'auth.add_group'
+
+    def get_user(self):
+        # A fresh instance each time, like a new request would have
+        return get_user_model()._default_manager.get(pk=self.default_user.pk)
+
+    def test_permissions_are_cached_across_instances(self):
+        backend = BaseBackend()
+        self.assertFalse(backend.has_perm(self.get_user(), self.perm_name))
+        user = self.get_user()
+        with self.assertNumQueries(0):
+            self.assertFalse(backend.has_perm(user, self.perm_name))
+
+    def test_user_permissions_change_invalidates(self):
+        backend = BaseBackend()
+        self.assertFalse(backend.has_perm(self.get_user(), self.perm_name))
+        self.default_user.user_permissions.add(self.permission)
+        self.assertTrue(backend.has_perm(self.get_user(), self.perm_name))
+
+    def test_group_changes_invalidate(self):
+        backend = BaseBackend()
+        group = Group.objects.create(name='editors')
+        self.assertFalse(backend.has_perm(self.get_user(), self.perm_name))
+        group.user_set.add(self.default_user)
+        self.assertFalse(backend.has_perm(self.get_user(), self.perm_name))
+        group.permissions.add(self.permission)
+        self.assertTrue(backend.has_perm(self.get_user(), self.perm_name))
+        group.delete()
+        self.assertFalse(backend.has_perm(self.get_user(), self.perm_name))
+
+
+class HashingExecutorTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        super(HashingExecutorTest, self).setUp()
+        self.executor = HashingExecutor(1, timeout=30)
+
+    def tearDown(self):
+        self.executor.close()
+        super(HashingExecutorTest, self).tearDown()
+
+    def test_passwords_hashed_in_pool(self):
+        with patch.object(hashing, 'get_executor', return_value=self.executor):
+            user = self.default_user
+            hashing.set_password(user, 'pooledpassword')
+            self.assertTrue(user.check_password('pooledpassword'))
+            self.assertTrue(hashing.check_password(user, 'pooledpassword'))
+            self.assertFalse(hashing.check_password(user, 'wrong'))
+            user.save()
+            self.assertEqual(BaseBackend().authenticate(user.get_username(), 'pooledpassword'), user)
+            with patch.object(BaseBackend, 'user_can_authenticate', create=True, return_value=False):
+                self.assertIsNone(BaseBackend().authenticate(user.get_username(), 'pooledpassword'))
+
+    def test_password_validators_notified(self):
+        self.login()
+        with patch.object(hashing, 'get_executor', return_value=self.executor), \
+                patch.object(hashing, 'password_validation') as password_validation:
+            self.client.post('/user/change_password/', {
+                'old_password': FIXTURE_USER_DATA['password'],
+                'new_password1': 'newpassword',
+                'new_password2': 'newpassword',
+            })
+        self.assertEqual(password_validation.password_changed.call_count, 1)
+        self.assertEqual(password_validation.password_changed.call_args[0][0], 'newpassword')
+
+    def test_full_queue_is_rejected(self):
+        executor = HashingExecutor(1, max_pending=1)
+        executor.get_pool()
+        executor._slots.acquire()
+        try:
+            self.assertRaises(HashingUnavailable, executor.make_password, 'password')
+        finally:
+            executor.close()
+
+    def test_timeout(self):
+        self.executor.timeout = 0.05
+        self.assertRaises(HashingUnavailable, self.executor.run, time.sleep, 1)
+
+    def test_view_answers_503(self):
+        self.login()
+        with patch.object(hashing, 'get_executor', return_value=self.executor), \
+                patch.object(HashingExecutor, 'run', side_effect=HashingUnavailable):
+            response = self.client.post('/user/change_password/', {
+                'old_password': FIXTURE_USER_DATA['password'],
+                'new_password1': 'newpassword',
+                'new_password2': 'newpassword',
+            })
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(self.default_user.check_password(FIXTURE_USER_DATA['password']))
+
+
+class CalibrateHasherTest(SkyVisitorTestCase):
+
+    def test_reports_latency_and_recommendation(self):
+        out = StringIO()
+        call_command('sky_visitor_calibrate_hasher', hashers=['django.contrib.auth.hashers.PBKDF2PasswordHasher',
+                                                              'django.contrib.auth.hashers.MD5PasswordHasher'],
+                     factors='100,200', concurrency=2, samples=2, target_ms=10000, stdout=out)
+        output = out.getvalue()
+        self.assertIn('iterations=100', output)
+        self.assertIn('p99', output)
+        self.assertIn('Recommended: iterations = ', output)
+        self.assertIn('MD5PasswordHasher: no work factor to tune, skipped', output)
+
+
+class LastLoginWriteBehindTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        super(LastLoginWriteBehindTest, self).setUp()
+        get_cache().clear()
+        last_login.install()
+
+    def tearDown(self):
+        last_login.uninstall()
+        super(LastLoginWriteBehindTest, self).tearDown()
+
+    def get_last_login(self):
+        return get_user_model()._default_manager.filter(pk=self.default_user.pk).values_list('last_login', flat=True)[0]
+
+    def test_login_is_written_on_flush(self):
+        before = self.get_last_login()
+        self.login()
+        self.assertEqual(self.get_last_login(), before)
+        self.assertIn(self.default_user.pk, last_login.buffer.pending)
+        with self.assertNumQueries(1):
+            last_login.buffer.flush()
+        self.assertNotEqual(self.get_last_login(), before)
+        self.assertEqual(last_login.buffer.pending, {})
+
+    def test_flush_when_batch_is_full(self):
+        UserModel = get_user_model()
+        other = UserModel._default_manager.exclude(pk=self.default_user.pk)[0]
+        now = timezone.now()
+        with patch.object(last_login.buffer, 'batch_size', 2):
+            last_login.buffer.add(self.default_user.pk, now)
+            last_login.buffer.add(other.pk, now - datetime.timedelta(hours=1))
+        self.assertEqual(self.get_last_login(), now)
+        self.assertEqual(UserModel._default_manager.get(pk=other.pk).last_login, now - datetime.timedelta(hours=1))
+
+    def test_reset_token_matches_after_flush(self):
+        self.login()
+        self.client.logout()
+        self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        self.assertNotIn(self.default_user.pk, last_login.buffer.pending)
+        # Whatever is still pending gets written, as the flush timer would
+        last_login.buffer.flush()
+        reset_url = re.search(r'/user/reset_password/\S+', mail.outbox[0].body).group(0)
+        response = self.client.get(reset_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.context['form'])
+
+    def test_reset_token_matches_after_other_process_flushes(self):
+        other_process = last_login.LastLoginBuffer(60, 100)
+        other_process.add(self.default_user.pk, timezone.now())
+        self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        other_process.flush()
+        reset_url = re.search(r'/user/reset_password/\S+', mail.outbox[0].body).group(0)
+        response = self.client.get(reset_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.context['form'])
+
+    def test_last_login_never_moves_back(self):
+        now = timezone.now()
+        last_login.buffer.add(self.default_user.pk, now)
+        last_login.buffer.flush()
+        last_login.buffer.add(self.default_user.pk, now - datetime.timedelta(hours=1))
+        last_login.buffer.flush()
+        self.assertEqual(self.get_last_login(), now)
+
+
+@patch.object(PageCacheMixin, 'page_cache_timeout', 60)
+@patch.object(StaticPageMixin, 'page_cache_timeout', 60)
+class PageCacheTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        get_cache().clear()
+
+    def get_csrf_value(self, response):
+        return re.search(r"name='csrfmiddlewaretoken' value='([^']+)'", response.content).group(1)
+
+    def test_page_is_cached_with_fresh_csrf_token(self):
+        first = self.client.get('/user/login/')
+        self.assertEqual(first.status_code, 200)
+        other_client = Client()
+        with patch.object(loader, 'select_template', side_effect=AssertionError("rendered again")), \
+                patch.object(loader, 'get_template', side_effect=AssertionError("rendered again")):
+            second = other_client.get('/user/login/')
+        self.assertEqual(second.status_code, 200)
+        self.assertNotIn(PageCacheMixin.csrf_placeholder, second.content)
+        self.assertNotEqual(self.get_csrf_value(first), self.get_csrf_value(second))
+        self.assertIn(settings.CSRF_COOKIE_NAME, second.cookies)
+
+    def test_query_strings_are_not_cached(self):
+        with patch.object(PageCacheMixin, 'get_page_cache_key') as get_page_cache_key:
+            for i in range(2):
+                self.assertEqual(self.client.get('/user/login/', {'x': i}).status_code, 200)
+            self.assertEqual(self.client.get('/user/login/', {'next': '/private/'}).status_code, 200)
+        self.assertFalse(get_page_cache_key.called)
+
+    def test_logged_in_users_are_not_cached(self):
+        self.client.get('/user/register/')
+        self.login()
+        response = self.client.get('/user/register/')
+        self.assertNotIn('AnonymousUser', response.content)
+
+    def test_check_email_page_has_etag(self):
+        response = self.client.get('/user/forgot_password/check_email/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=60', response['Cache-Control'])
+        self.assertNotIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        response = self.client.get('/user/forgot_password/check_email/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class AsyncTemplateSenderTest(SkyVisitorTestCase):
+
+    def setUp(self):
+        super(AsyncTemplateSenderTest, self).setUp()
+        self.server = LocalSMTPServer().start()
+        self.settings_override = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                                   EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.port)
+        self.settings_override.enable()
+        self.pool = SMTPPool(2, max_in_flight=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.settings_override.disable()
+        self.server.stop()
+        super(AsyncTemplateSenderTest, self).tearDown()
+
+    def test_send_many_over_kept_open_connections(self):
+        sender = AsyncTemplateSender(pool=self.pool)
+        messages = [{
+            'template_name': 'sky_visitor/email/invitation_complete.html',
+            'to_address': 'user%d@example.com' % i,
+            'subject': 'Invitation',
+            'context': {'token_url': 'http://testserver/%d/' % i},
+        } for i in range(20)]
+        results = sender.send_many(messages)
+        self.assertEqual(results, [('user%d@example.com' % i, True, None) for i in range(20)])
+        self.assertEqual(len(self.server.messages), 20)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_send_returns_before_delivery(self):
+        sender = AsyncTemplateSender(pool=self.pool)
+        result = sender.send('sky_visitor/email/invitation_complete.html', 'user@example.com', subject='Invitation',
+                             context={'token_url': 'http://testserver/'})
+        message, error = result.get(timeout=10)
+        self.assertIsNone(error)
+        self.assertEqual(message.to, ['user@example.com'])
+        self.assertEqual(self.server.messages[0][1], ['user@example.com'])
+
+    def test_unreachable_server_is_reported(self):
+        with override_settings(EMAIL_PORT=1), patch('sky_visitor.template_email_senders.logger') as logger:
+            sender = AsyncTemplateSender(pool=SMTPPool(1))
+            try:
+                [(recipient, sent, error)] = sender.send_many([{
+                    'template_name': 'sky_visitor/email/invitation_complete.html',
+                    'to_address': 'user@example.com',
+                }])
+                self.assertEqual((recipient, sent), ('user@example.com', False))
+                self.assertTrue(error)
+                self.assertEqual(logger.error.call_count, 1)
+            finally:
+                sender.pool.close()
+
+
 class LogoutViewTest(SkyVisitorViewsTestCase):
 
     def confirm_logged_out(self):
@@ -158,6 +565,14 @@ class ForgotPasswordProcessTest(SkyVisitorViewsTestCase):
             url = 'http://testserver%s' % url
         return url
 
+    def test_forgot_password_reports_send_failure(self):
+        with patch.object(locmem.EmailBackend, 'send_messages', side_effect=IOError('relay down')), \
+                patch('sky_visitor.template_email_senders.logger') as logger:
+            response = self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(logger.exception.called)
+        self.assertEqual([unicode(m) for m in response.context['messages']], [ForgotPasswordView.send_failed_message])
+
     def test_forgot_password_form_should_send_email(self):
         response = self.client.get('/user/forgot_password/')
         self.assertEqual(response.status_code, 200)
@@ -179,6 +594,25 @@ class ForgotPasswordProcessTest(SkyVisitorViewsTestCase):
         response2 = self.client.get(self._get_password_reset_url())
         self.assertIsInstance(response2.context_data['form'], SetPasswordForm)
 
+    def test_repeat_submits_should_send_one_email(self):
+        get_cache().clear()
+        with patch.object(ForgotPasswordView, 'coalesce_window', 60):
+            for email in (FIXTURE_USER_DATA['email'], FIXTURE_USER_DATA['email'].upper(), FIXTURE_USER_DATA['email']):
+                response = self.client.post('/user/forgot_password/', {'email': email})
+                self.assertRedirected(response, '/user/forgot_password/check_email/')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_send_should_not_coalesce_retry(self):
+        get_cache().clear()
+        with patch.object(ForgotPasswordView, 'coalesce_window', 60):
+            with patch.object(locmem.EmailBackend, 'send_messages', side_effect=IOError('relay down')), \
+                    patch('sky_visitor.template_email_senders.logger'):
+                response = self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+            self.assertRedirected(response, '/user/forgot_password/check_email/')
+        self.assertEqual(len(mail.outbox), 1)
+
     def test_reset_password_form_should_success_with_valid_input(self):
         UserModel = get_user_model()
         response = self.client.get(self._get_password_reset_url())
@@ -205,6 +639,24 @@ class ForgotPasswordProcessTest(SkyVisitorViewsTestCase):
         response2 = self.client.get(self._get_password_reset_url(), follow=True)
         self.assertRedirects(response2, '/user/login/')
 
+    def test_reset_password_link_should_use_one_query(self):
+        url = self._get_password_reset_url()
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid_reset_link_should_be_remembered(self):
+        get_cache().clear()
+        url = '/user/reset_password/1-35t-d4e092280eb134000671/'
+        with patch.object(ResetPasswordView, 'invalid_token_cache_timeout', 60):
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertRedirected(response, '/user/login/')
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertRedirected(response, '/user/login/')
+        self.assertEqual(get_invalid_token_cache_stats(), {'hits': 1, 'misses': 1})
+
     def test_reset_password_form_should_fail_with_invalid_token(self):
         # Should work fine for normal URL
         response = self.client.get(self._get_password_reset_url())
@@ -269,7 +721,7 @@ class InvitationProcessTest(RegisterUserMixin, SkyVisitorViewsTestCase):
     invited_user_email = 'invited@example.com'
 
     def _get_invitation_complete_url(self, user=None, with_host=True):
-        url = reverse('invitation_complete', kwargs={'uidb36': int_to_base36(user.id), 'token': default_token_generator.make_token(user)})
+        url = reverse('invitation_complete', kwargs={'uidb36': int_to_base36(user.id), 'token': invitation_token_generator.make_token(user)})
         if with_host:
             url = 'http://testserver%s' % url
         return url
@@ -310,6 +762,35 @@ class InvitationProcessTest(RegisterUserMixin, SkyVisitorViewsTestCase):
         response2 = self.client.get(invitation_complete_url)
         self.assertIsInstance(response2.context_data['form'], InvitationCompleteForm)
 
+    def test_invitation_link_should_use_one_query(self):
+        invited_user = self._invite_user()
+        invitation_complete_url = self._get_invitation_complete_url(invited_user)
+        with self.assertNumQueries(1):
+            response = self.client.get(invitation_complete_url)
+        self.assertEqual(response.status_code, 200)
+
+        # Once the invitation is used its status changes and the token stops working
+        user = get_user_model()._default_manager.get(email=FIXTURE_USER_DATA['email'])
+        InvitedUser.objects.filter(id=invited_user.id).update(created_user=user, status=InvitedUser.STATUS_REGISTERED)
+        with self.assertNumQueries(1):
+            response = self.client.get(invitation_complete_url)
+        self.assertRedirected(response, '/user/login/')
+
+    def test_invitation_link_should_expire(self):
+        invited_user = self._invite_user()
+        invitation_complete_url = self._get_invitation_complete_url(invited_user)
+        with patch.object(invitation_token_generator, 'timeout', -1):
+            with self.assertNumQueries(0):
+                response = self.client.get(invitation_complete_url)
+        self.assertRedirected(response, '/user/login/')
+
+    def test_legacy_invitation_link_should_work(self):
+        invited_user = self._invite_user()
+        url = reverse('invitation_complete', kwargs={'uidb36': int_to_base36(invited_user.id),
+                                                     'token': default_token_generator.make_token(invited_user)})
+        response = self.client.get(url)
+        self.assertIsInstance(response.context_data['form'], InvitationCompleteForm)
+
     def test_should_not_allow_duplicate_invitation(self):
         data = {
             'email': self.invited_user_email
@@ -354,3 +835,272 @@ class InvitationProcessTest(RegisterUserMixin, SkyVisitorViewsTestCase):
         invited_user_updated = InvitedUser.objects.get(email=invited_user.email)
         self.assertEqual(invited_user_updated.created_user.id, user.id)
         self.assertEqual(invited_user_updated.status, InvitedUser.STATUS_REGISTERED)
+
+
+class BulkInvitationTest(SkyVisitorViewsTestCase):
+
+    def test_bulk_invite_reports_each_row(self):
+        InvitedUser.objects.create(email='already@example.com')
+        report = InvitedUser.objects.bulk_invite([
+            ('new1@example.com', 'New One'),
+            (FIXTURE_USER_DATA['email'], ''),
+            ('already@example.com', None),
+            ('not-an-email', None),
+            ('new2@example.com', None),
+            ('new1@example.com', None),
+            (FIXTURE_USER_DATA['email'], None),
+        ])
+        self.assertEqual(report, [
+            ('new1@example.com', InvitedUser.INVITE_CREATED),
+            (FIXTURE_USER_DATA['email'], InvitedUser.INVITE_ALREADY_USER),
+            ('already@example.com', InvitedUser.INVITE_ALREADY_INVITED),
+            ('not-an-email', InvitedUser.INVITE_INVALID),
+            ('new2@example.com', InvitedUser.INVITE_CREATED),
+            ('new1@example.com', InvitedUser.INVITE_ALREADY_INVITED),
+            (FIXTURE_USER_DATA['email'], InvitedUser.INVITE_ALREADY_USER),
+        ])
+        invited_user = InvitedUser.objects.get(email='new1@example.com')
+        self.assertEqual(invited_user.name, 'New One')
+        self.assertEqual(invited_user.status, InvitedUser.STATUS_INVITED)
+        # SKY_SEND_USER_PASSWORD is off, so no temporary password until one is asked for
+        self.assertIsNone(invited_user.enc_password)
+        self.assertEqual(InvitedUser.objects.count(), 3)
+
+    def test_bulk_invite_generates_passwords_when_sending_them(self):
+        with patch('sky_visitor.models.SEND_USER_PASSWORD', True):
+            InvitedUser.objects.bulk_invite([('new1@example.com', None)])
+        self.assertTrue(InvitedUser.objects.get(email='new1@example.com').enc_password)
+
+    def test_password_is_generated_lazily(self):
+        invited_user = InvitedUser.objects.create(email='lazy@example.com')
+        self.assertIsNone(invited_user.enc_password)
+        password = invited_user.get_password()
+        self.assertEqual(len(password), 8)
+        # Stored, and the same from then on
+        self.assertEqual(InvitedUser.objects.get(id=invited_user.id).get_password(), password)
+
+    def test_backfill_passwords(self):
+        InvitedUser.objects.bulk_invite([('new%d@example.com' % i, None) for i in range(5)])
+        self.assertEqual(InvitedUser.objects.without_password().count(), 5)
+        self.assertEqual(InvitedUser.objects.all().backfill_passwords(chunk_size=2), 5)
+        self.assertEqual(InvitedUser.objects.without_password().count(), 0)
+        self.assertEqual(InvitedUser.objects.all().backfill_passwords(), 0)
+
+    def test_bulk_invite_queries_per_chunk(self):
+        invitations = [('bulk%d@example.com' % i, None) for i in range(10)]
+        # Two lookups and one insert per chunk of five
+        with self.assertNumQueries(6):
+            InvitedUser.objects.bulk_invite(invitations, chunk_size=5)
+        self.assertEqual(InvitedUser.objects.count(), 10)
+
+
+class EmailOutboxTest(SkyVisitorViewsTestCase):
+
+    def _enqueue(self, to='outbox@example.com'):
+        message = EmailMultiAlternatives(subject='Subject', body='Body', to=[to])
+        message.attach_alternative('<p>Body</p>', 'text/html')
+        return EmailOutbox.objects.enqueue(message)
+
+    def test_view_queues_email_instead_of_sending(self):
+        with patch.object(ForgotPasswordView, 'use_email_outbox', True):
+            response = self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        self.assertRedirected(response, '/user/forgot_password/check_email/')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.queue_depth(), 1)
+
+        call_command('sky_visitor_outbox_worker', once=True, verbosity=0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [FIXTURE_USER_DATA['email']])
+        self.assertEqual(mail.outbox[0].subject, 'Password reset for testserver')
+        self.assertEqual(EmailOutbox.objects.queue_depth(), 0)
+        self.assertEqual(EmailOutbox.objects.get().status, EmailOutbox.STATUS_SENT)
+
+    @override_settings(ROOT_URLCONF='sky_visitor.urls_outbox')
+    def test_outbox_urls_queue_email(self):
+        response = self.client.post('/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        self.assertRedirected(response, '/forgot_password/check_email/')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(EmailOutbox.objects.queue_depth(), 1)
+
+    def test_sender_without_build_message_is_rejected(self):
+        with patch('sky_visitor.views.mixins.TEMPLATE_EMAIL_SENDER_CLASS', BaseTemplateSender), \
+                patch.object(ForgotPasswordView, 'use_email_outbox', True):
+            self.assertRaises(ImproperlyConfigured, self.client.post, '/user/forgot_password/',
+                              {'email': FIXTURE_USER_DATA['email']})
+        self.assertEqual(EmailOutbox.objects.queue_depth(), 0)
+
+    def test_worker_retries_with_backoff_then_gives_up(self):
+        queued = self._enqueue()
+        with patch.object(locmem.EmailBackend, 'send_messages', side_effect=IOError('relay down')):
+            call_command('sky_visitor_outbox_worker', once=True, max_attempts=2, retry_delay=60, verbosity=0)
+            queued = EmailOutbox.objects.get(id=queued.id)
+            self.assertEqual(queued.status, EmailOutbox.STATUS_PENDING)
+            self.assertEqual(queued.attempts, 1)
+            self.assertIn('relay down', queued.last_error)
+            self.assertGreater(queued.next_attempt_at, timezone.now())
+
+            EmailOutbox.objects.filter(id=queued.id).update(next_attempt_at=timezone.now())
+            call_command('sky_visitor_outbox_worker', once=True, max_attempts=2, retry_delay=60, verbosity=0)
+            self.assertEqual(EmailOutbox.objects.get(id=queued.id).status, EmailOutbox.STATUS_FAILED)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class TemplateSenderTest(SkyVisitorViewsTestCase):
+    template_name = 'sky_visitor/email/visitor-forgot-password.html'
+
+    def _messages(self, count):
+        return [{
+            'template_name': self.template_name,
+            'to_address': 'user%d@example.com' % i,
+            'subject': 'Hello {{ name }}',
+            'context': {'name': 'user%d' % i},
+        } for i in range(count)]
+
+    def test_send_many_reuses_connection(self):
+        with patch('sky_visitor.template_email_senders.get_connection', wraps=get_connection) as connect:
+            results = DjangoTemplateSender().send_many(self._messages(3))
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(results, [('user0@example.com', True, None), ('user1@example.com', True, None),
+                                   ('user2@example.com', True, None)])
+        self.assertEqual([m.subject for m in mail.outbox], ['Hello user0', 'Hello user1', 'Hello user2'])
+
+    def test_send_many_reports_failed_recipients(self):
+        original = locmem.EmailBackend.send_messages
+
+        def refuse_user1(backend, messages):
+            if 'user1@example.com' in messages[0].to:
+                raise IOError('refused')
+            return original(backend, messages)
+
+        with patch.object(locmem.EmailBackend, 'send_messages', refuse_user1):
+            results = DjangoTemplateSender().send_many(self._messages(3), batch_size=2)
+        self.assertEqual(results, [('user0@example.com', True, None), ('user1@example.com', False, 'IOError: refused'),
+                                   ('user2@example.com', True, None)])
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_only_lost_connections_are_retried(self):
+        for error, attempts in ((smtplib.SMTPServerDisconnected('idle'), 2),
+                                (smtplib.SMTPRecipientsRefused({'user0@example.com': (550, 'unknown')}), 1)):
+            with patch.object(locmem.EmailBackend, 'send_messages', side_effect=error) as send, \
+                    patch('sky_visitor.template_email_senders.logger'):
+                [(recipient, sent, message)] = DjangoTemplateSender().send_many(self._messages(1))
+            self.assertFalse(sent)
+            self.assertEqual(send.call_count, attempts)
+
+    def test_templates_are_compiled_once(self):
+        DjangoTemplateSender.template_cache.clear()
+        messages = self._messages(3)
+        for kwargs in messages:
+            kwargs['text_template_name'] = 'sky_visitor/email/does-not-exist.txt'
+        with patch('sky_visitor.template_email_senders.loader.get_template', wraps=loader.get_template) as get_template:
+            DjangoTemplateSender().send_many(messages)
+        # One lookup for the HTML template and one for the missing text template
+        self.assertEqual(get_template.call_count, 2)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[2].subject, 'Hello user2')
+
+    @skipIf(jinja2 is None, "Jinja2 is not installed")
+    def test_jinja2_sender(self):
+        messages = self._messages(1)
+        messages[0]['subject'] = 'Tom & {{ name }}'
+        messages[0]['context'] = {'name': 'Jerry', 'token_url': 'http://testserver/?a=1&b=2'}
+        results = Jinja2TemplateSender().send_many(messages)
+        self.assertEqual(results, [('user0@example.com', True, None)])
+        message = mail.outbox[0]
+        self.assertEqual(message.subject, 'Tom & Jerry')
+        self.assertIn('http://testserver/?a=1&amp;b=2', message.alternatives[0][0])
+
+
+class EncryptionTest(SkyVisitorTestCase):
+    key = 'invited@example.com_secret'
+
+    def _legacy_encrypt(self, value, enc=None):
+        enc = enc or Encryption(self.key)
+        pickled = pickle.dumps(value)
+        padded = pickled + (' ' * (16 - (len(pickled) % 16)))
+        return binascii.b2a_hex(enc.get_cipher_instance().encrypt(padded))
+
+    def test_round_trip(self):
+        enc = Encryption(self.key)
+        values = [u'password', u'p\xe4ssword', u'a' * 40, u'']
+        encrypted = enc.encrypt_many(values)
+        self.assertEqual(enc.decrypt_many(encrypted), values)
+        for enc_value in encrypted:
+            self.assertTrue(enc_value.startswith(Encryption.FORMAT_PREFIX))
+        # Much smaller than the old format
+        self.assertEqual(len(enc.encrypt('password')), 24)
+        self.assertEqual(len(self._legacy_encrypt('password')), 64)
+
+    def test_decrypts_legacy_format(self):
+        enc = Encryption(self.key)
+        self.assertEqual(enc.decrypt(self._legacy_encrypt('password')), 'password')
+
+    def test_migrate_enc_passwords(self):
+        InvitedUser.objects.bulk_invite([('new%d@example.com' % i, None) for i in range(3)])
+        legacy_password = self._legacy_encrypt('secret', InvitedUser(email='new0@example.com').get_encrypter())
+        InvitedUser.objects.filter(email='new0@example.com').update(enc_password=legacy_password)
+        call_command('sky_visitor_migrate_enc_passwords', chunk_size=2, verbosity=0)
+        invited_user = InvitedUser.objects.get(email='new0@example.com')
+        self.assertTrue(invited_user.enc_password.startswith(Encryption.FORMAT_PREFIX))
+        self.assertEqual(invited_user.decrypt_password(), 'secret')
+
+
+class MakePasswordsTest(SkyVisitorTestCase):
+
+    def test_make_passwords(self):
+        passwords = list(make_passwords(1000, length=10, alphabet='abc'))
+        self.assertEqual(len(passwords), 1000)
+        for password in passwords:
+            self.assertEqual(len(password), 10)
+            self.assertTrue(set(password) <= set('abc'))
+        self.assertEqual(len(set(make_passwords(1000))), 1000)
+
+    def test_invalid_alphabet(self):
+        self.assertRaises(ValueError, list, make_passwords(1, alphabet=''))
+        self.assertRaises(ValueError, list, make_passwords(1, alphabet='a' * 257))
+
+
+class SignedTokenGeneratorTest(SkyVisitorViewsTestCase):
+
+    def setUp(self):
+        self.generator = SignedTokenGenerator('password_reset', timeout=60)
+
+    def _get_reset_response(self, uidb36, token):
+        request = RequestFactory().get('/')
+        request._messages = CookieStorage(request)
+        view = ResetPasswordView.as_view(token_generator=self.generator)
+        return view(request, uidb36=uidb36, token=token)
+
+    def test_token_fits_url_pattern(self):
+        token = self.generator.make_token(self.default_user)
+        reverse('reset_password', kwargs={'uidb36': int_to_base36(self.default_user.id), 'token': token})
+        self.assertTrue(self.generator.check_token(self.default_user, token))
+
+    def test_used_token_is_invalid(self):
+        token = self.generator.make_token(self.default_user)
+        self.default_user.set_password('changed')
+        self.assertTrue(self.generator.check_token_signature(self.default_user.id, token))
+        self.assertFalse(self.generator.check_token(self.default_user, token))
+
+    def test_bad_tokens_are_rejected_without_queries(self):
+        token = self.generator.make_token(self.default_user)
+        uidb36 = int_to_base36(self.default_user.id)
+        expired = SignedTokenGenerator('password_reset', timeout=-1)
+        other_purpose = SignedTokenGenerator('invitation', timeout=60).make_token(self.default_user)
+        ts_b36, hashes = token.split('-')
+        bad_tokens = [
+            (uidb36, '%s-%s%s' % (ts_b36, '0' if hashes[0] != '0' else '1', hashes[1:])),
+            (uidb36, other_purpose),
+            (uidb36, 'zz-' + hashes),
+            (int_to_base36(self.default_user.id + 1), token),
+        ]
+        for bad_uidb36, bad_token in bad_tokens:
+            with self.assertNumQueries(0):
+                response = self._get_reset_response(bad_uidb36, bad_token)
+            self.assertEqual(response.status_code, 302)
+
+        # The signature check is fine, but the state check needs the user
+        self.assertFalse(expired.check_token_signature(self.default_user.id, token))
+        with self.assertNumQueries(1):
+            response = self._get_reset_response(uidb36, token)
+        self.assertEqual(response.status_code, 200)
@@ -13,3 +13,5 @@
 # limitations under the License.
 
 __version__ = (1, 2, 0)
+
+default_app_config = 'sky_visitor.apps.SkyVisitorConfig'
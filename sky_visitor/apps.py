@@ -0,0 +1,27 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from django.apps import AppConfig
+
+
+class SkyVisitorConfig(AppConfig):
+    name = 'sky_visitor'
+    verbose_name = "Sky Visitor"
+
+    def ready(self):
+        # Imported here because sky_visitor.config loads the email sender, which imports models
+        from sky_visitor.config import LAST_LOGIN_WRITE_BEHIND
+        if LAST_LOGIN_WRITE_BEHIND:
+            # Needs to run after django.contrib.auth's ready(), so list sky_visitor after it in INSTALLED_APPS
+            from sky_visitor import last_login
+            last_login.install()
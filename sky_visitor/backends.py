@@ -11,7 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from django.contrib.auth import login, backends
+from django.conf import settings
+from django.contrib.auth import login, backends, get_user_model
+from django.utils.module_loading import import_string
+
+from sky_visitor.cache import get_cache, get_versions, make_key, permission_version_key, user_key
+from sky_visitor.config import PERMISSION_CACHE_TIMEOUT, USER_CACHE_TIMEOUT
+from sky_visitor.hashing import check_password, set_password
+from sky_visitor.shortcuts import get_users_by_email
 
 
 # Reference: http://groups.google.com/group/django-users/browse_thread/thread/39488db1864c595f
@@ -19,9 +26,97 @@ def auto_login(request, user):
     """
     Allows you to fake a login in your code
     """
-    user.backend = 'sky_visitor.backends.BaseBackend'
+    user.backend = get_login_backend_path()
     login(request, user)
 
 
+def get_login_backend_path():
+    """
+    The first backend in AUTHENTICATION_BACKENDS that is a BaseBackend, such as CachedUserBackend, so that the session
+    keeps using it. Falls back to BaseBackend itself.
+    """
+    for path in settings.AUTHENTICATION_BACKENDS:
+        if issubclass(import_string(path), BaseBackend):
+            return path
+    return 'sky_visitor.backends.BaseBackend'
+
+
 class BaseBackend(backends.ModelBackend):
-    pass
+    """
+    With `permission_cache_timeout` set, keeps each user's permission set in the cache so permission checks don't
+    query the database on every request. The entries are versioned, and changes to a user's groups or permissions,
+    or to any group, move to a new version.
+    """
+    permission_cache_timeout = PERMISSION_CACHE_TIMEOUT
+
+    def authenticate(self, username=None, password=None, **kwargs):
+        # ModelBackend.authenticate(), hashing through sky_visitor.hashing
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Run the hasher anyway so unknown usernames take as long as wrong passwords
+            set_password(UserModel(), password)
+            return None
+        # user_can_authenticate() (inactive users can't log in) is new in Django 1.10
+        if check_password(user, password) and getattr(self, 'user_can_authenticate', lambda user: True)(user):
+            return user
+        return None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not self.permission_cache_timeout or hasattr(user_obj, '_perm_cache') or not user_obj.is_active or \
+                user_obj.is_anonymous() or obj is not None:
+            return super(BaseBackend, self).get_all_permissions(user_obj, obj)
+        versions = get_versions(permission_version_key(), permission_version_key(user_obj.pk))
+        is_superuser = getattr(user_obj, 'is_superuser', False)
+        key = make_key('perms', unicode(user_obj.pk), unicode(is_superuser), *[unicode(v) for v in versions])
+        cache = get_cache()
+        perms = cache.get(key)
+        if perms is None:
+            perms = super(BaseBackend, self).get_all_permissions(user_obj, obj)
+            cache.set(key, perms, self.permission_cache_timeout)
+        user_obj._perm_cache = perms
+        return perms
+
+
+class EmailBackend(BaseBackend):
+    """
+    Authenticates by email address, case insensitively. Accepts the address as either `email` or `username`, so it
+    also works with `LoginForm`.
+    """
+
+    def authenticate(self, username=None, password=None, email=None, **kwargs):
+        email = email or username
+        if not email or password is None:
+            return None
+        users = list(get_users_by_email(email)[:2])
+        if len(users) != 1:
+            # Run the hasher anyway so unknown and ambiguous addresses take as long as wrong passwords
+            set_password(get_user_model()(), password)
+            return None
+        user = users[0]
+        # user_can_authenticate() (inactive users can't log in) is new in Django 1.10
+        if check_password(user, password) and getattr(self, 'user_can_authenticate', lambda user: True)(user):
+            return user
+        return None
+
+
+class CachedUserBackend(BaseBackend):
+    """
+    Serves `get_user()`, which runs on every authenticated request, from the cache instead of the database. Saving or
+    deleting a user drops it from the cache, so do changes through the ORM's `save()`/`delete()`; a queryset
+    `update()` goes unnoticed until `cache_timeout` runs out.
+    """
+    cache_timeout = USER_CACHE_TIMEOUT
+
+    def get_user(self, user_id):
+        cache = get_cache()
+        key = user_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super(CachedUserBackend, self).get_user(user_id)
+            if user is not None:
+                cache.set(key, user, self.cache_timeout)
+        return user
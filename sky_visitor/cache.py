@@ -0,0 +1,113 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import time
+
+from django.core.cache import caches
+
+from sky_visitor.config import CACHE_ALIAS
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def make_key(prefix, *parts):
+    """
+    Build a cache key that is safe for memcached whatever `parts` contains.
+    """
+    digest = hashlib.md5(u'|'.join(parts).encode('utf-8')).hexdigest()
+    return 'sky_visitor.%s.%s' % (prefix, digest)
+
+
+def incr(key, delta=1, timeout=None):
+    """
+    Increment a counter, creating it if it doesn't exist. Returns the new value.
+    """
+    cache = get_cache()
+    if cache.add(key, delta, timeout):
+        return delta
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.add(key, delta, timeout)
+        return delta
+
+
+def get_counters(*keys):
+    values = get_cache().get_many(keys)
+    return dict((key, values.get(key, 0)) for key in keys)
+
+
+def count_recent(key, period):
+    """
+    Count a request against `key` and return roughly how many were counted in the last `period` seconds.
+
+    Uses a sliding window over two fixed window counters (the previous one weighted by how much of it still falls in
+    the last `period` seconds), since the cache only offers atomic increments, not compare-and-swap.
+    """
+    now = time.time()
+    window = int(now // period)
+    count = incr('%s.%d' % (key, window), timeout=period * 2)
+    previous = get_cache().get('%s.%d' % (key, window - 1)) or 0
+    return previous * (1 - (now % period) / float(period)) + count
+
+
+def user_key(user_id):
+    return make_key('user', unicode(user_id))
+
+
+def last_login_key(user_id):
+    """
+    A user's last_login that is waiting in some process's write-behind buffer.
+    """
+    return make_key('last_login', unicode(user_id))
+
+
+def invalidate_cached_user(user_id):
+    """
+    Drop a user from CachedUserBackend's cache, so the next request loads it from the database again.
+    """
+    get_cache().delete(user_key(user_id))
+
+
+def get_versions(*keys):
+    """
+    Read version counters, starting missing ones at the current time rather than 0 so that a counter that was
+    evicted doesn't come back at a value entries are still cached under.
+    """
+    cache = get_cache()
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            cache.add(key, int(time.time() * 1000), None)
+            values[key] = cache.get(key, 0)
+    return [values[key] for key in keys]
+
+
+def bump_version(key):
+    try:
+        get_cache().incr(key)
+    except ValueError:
+        get_versions(key)
+
+
+def permission_version_key(user_id=None):
+    """
+    Version of a user's cached permissions, or with no `user_id`, of everyone's (for changes to groups).
+    """
+    if user_id is None:
+        return 'sky_visitor.perm_version'
+    return make_key('perm_version', unicode(user_id))
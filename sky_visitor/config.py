@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 
 
@@ -7,3 +8,65 @@ TEMPLATE_EMAIL_SENDER = getattr(settings, 'SKY_TEMPLATE_EMAIL_SENDER', 'sky_visi
 TEMPLATE_EMAIL_SENDER_CLASS = import_string(TEMPLATE_EMAIL_SENDER)
 
 SEND_USER_PASSWORD = getattr(settings, 'SKY_SEND_USER_PASSWORD', False)
+
+# Number of emails checked per `IN (...)` query and inserted per `bulk_create` in InvitedUser.objects.bulk_invite()
+BULK_INVITE_CHUNK_SIZE = getattr(settings, 'SKY_BULK_INVITE_CHUNK_SIZE', 500)
+
+# Queue token emails in the EmailOutbox table instead of sending them during the request. Run
+# `manage.py sky_visitor_outbox_worker` to deliver them.
+EMAIL_OUTBOX = getattr(settings, 'SKY_EMAIL_OUTBOX', False)
+if EMAIL_OUTBOX and not TEMPLATE_EMAIL_SENDER_CLASS.can_build_messages():
+    raise ImproperlyConfigured("SKY_EMAIL_OUTBOX needs a SKY_TEMPLATE_EMAIL_SENDER that implements build_message(), "
+                               "%s doesn't." % TEMPLATE_EMAIL_SENDER)
+EMAIL_OUTBOX_BATCH_SIZE = getattr(settings, 'SKY_EMAIL_OUTBOX_BATCH_SIZE', 100)
+EMAIL_OUTBOX_CONCURRENCY = getattr(settings, 'SKY_EMAIL_OUTBOX_CONCURRENCY', 4)
+EMAIL_OUTBOX_MAX_ATTEMPTS = getattr(settings, 'SKY_EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+# Seconds before the first retry, doubled after every further failed attempt
+EMAIL_OUTBOX_RETRY_DELAY = getattr(settings, 'SKY_EMAIL_OUTBOX_RETRY_DELAY', 60)
+
+# Seconds an invitation link stays valid
+INVITATION_TTL = getattr(settings, 'SKY_INVITATION_TTL', 60 * 60 * 24 * 7)
+
+# Cache used for sky_visitor's own caching (invalid token links, rate limits, ...)
+CACHE_ALIAS = getattr(settings, 'SKY_CACHE_ALIAS', 'default')
+
+# Seconds to remember token links that turned out to be invalid, so repeat hits skip the database. 0 turns it off.
+INVALID_TOKEN_CACHE_TIMEOUT = getattr(settings, 'SKY_INVALID_TOKEN_CACHE_TIMEOUT', 0)
+
+# Default `(requests, seconds)` limits on login and forgot password submissions, per client IP and per submitted
+# username/email. None turns a limit off. Can also be set on each view.
+RATE_LIMIT_PER_IP = getattr(settings, 'SKY_RATE_LIMIT_PER_IP', None)
+RATE_LIMIT_PER_USER = getattr(settings, 'SKY_RATE_LIMIT_PER_USER', None)
+
+# Seconds during which repeat forgot password submits for the same email address don't send another email. 0 turns
+# it off.
+FORGOT_PASSWORD_COALESCE_WINDOW = getattr(settings, 'SKY_FORGOT_PASSWORD_COALESCE_WINDOW', 0)
+
+# Seconds CachedUserBackend keeps a user loaded by get_user() in the cache
+USER_CACHE_TIMEOUT = getattr(settings, 'SKY_USER_CACHE_TIMEOUT', 60 * 5)
+
+# Seconds BaseBackend keeps a user's permission set in the cache. 0 turns it off.
+PERMISSION_CACHE_TIMEOUT = getattr(settings, 'SKY_PERMISSION_CACHE_TIMEOUT', 0)
+
+# Number of worker processes password hashing runs in, keeping it off request threads. 0 hashes in the request thread.
+HASHING_PROCESSES = getattr(settings, 'SKY_HASHING_PROCESSES', 0)
+# Hashing jobs that may be queued or running before more are turned away with a 503. Defaults to 4 per process.
+HASHING_MAX_PENDING = getattr(settings, 'SKY_HASHING_MAX_PENDING', None)
+# Seconds a request waits for its hashing job before giving up with a 503
+HASHING_TIMEOUT = getattr(settings, 'SKY_HASHING_TIMEOUT', 10)
+
+# How LoginView checks that the browser accepts cookies: 'session' stores the test cookie in the session, which saves a
+# session for every anonymous visitor, 'signed' uses a signed cookie of its own and None skips the check.
+LOGIN_TEST_COOKIE = getattr(settings, 'SKY_LOGIN_TEST_COOKIE', 'session')
+
+# Buffer last_login updates on login and write them in batches instead of saving the user every time. A user's
+# last_login reaches the database at most LAST_LOGIN_FLUSH_INTERVAL seconds late, or when LAST_LOGIN_BATCH_SIZE users
+# are waiting.
+LAST_LOGIN_WRITE_BEHIND = getattr(settings, 'SKY_LAST_LOGIN_WRITE_BEHIND', False)
+LAST_LOGIN_FLUSH_INTERVAL = getattr(settings, 'SKY_LAST_LOGIN_FLUSH_INTERVAL', 10)
+LAST_LOGIN_BATCH_SIZE = getattr(settings, 'SKY_LAST_LOGIN_BATCH_SIZE', 100)
+
+# Seconds to cache the rendered login, register, forgot password and invitation pages for anonymous visitors. 0 turns
+# it off. Change SKY_PAGE_CACHE_VERSION on every deploy that changes templates, so old pages aren't served.
+PAGE_CACHE_TIMEOUT = getattr(settings, 'SKY_PAGE_CACHE_TIMEOUT', 0)
+PAGE_CACHE_VERSION = getattr(settings, 'SKY_PAGE_CACHE_VERSION', '')
@@ -18,6 +18,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import forms as auth_forms, get_user_model
 
 from sky_visitor.forms.fields import PasswordRulesField
+from sky_visitor.hashing import check_password, password_changed, set_password
 from sky_visitor.models import InvitedUser
 from ..config import SEND_USER_PASSWORD
 
@@ -47,6 +48,14 @@ class RegisterForm(auth_forms.UserCreationForm):
             return username
         raise forms.ValidationError(self.error_messages['duplicate_username'])
 
+    def save(self, commit=True):
+        # Skip UserCreationForm.save(), which hashes the password in the request thread
+        user = super(auth_forms.UserCreationForm, self).save(commit=False)
+        set_password(user, self.cleaned_data["password1"])
+        if commit:
+            user.save()
+        return user
+
 
 class LoginForm(auth_forms.AuthenticationForm):
     # Note: The username field will always be called 'username' despite what UserModel.USERNAME_FIELD is
@@ -65,10 +74,32 @@ class PasswordResetForm(auth_forms.PasswordResetForm):
 class SetPasswordForm(auth_forms.SetPasswordForm):
     new_password1 = PasswordRulesField(label=_("New password"))
 
+    def save(self, commit=True):
+        password = self.cleaned_data['new_password1']
+        set_password(self.user, password)
+        if commit:
+            self.user.save()
+            password_changed(self.user, password)
+        return self.user
+
 
 class PasswordChangeForm(auth_forms.PasswordChangeForm):
     new_password1 = PasswordRulesField(label=_("New password"))
 
+    def clean_old_password(self):
+        old_password = self.cleaned_data["old_password"]
+        if not check_password(self.user, old_password):
+            raise forms.ValidationError(self.error_messages['password_incorrect'], code='password_incorrect')
+        return old_password
+
+    def save(self, commit=True):
+        password = self.cleaned_data['new_password1']
+        set_password(self.user, password)
+        if commit:
+            self.user.save()
+            password_changed(self.user, password)
+        return self.user
+
 
 class InvitationStartForm(forms.ModelForm):
 
@@ -0,0 +1,166 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import multiprocessing
+import os
+import threading
+
+from django.contrib.auth import hashers
+
+try:
+    from django.contrib.auth import password_validation
+except ImportError:
+    # Django < 1.9
+    password_validation = None
+
+from sky_visitor.config import HASHING_PROCESSES, HASHING_MAX_PENDING, HASHING_TIMEOUT
+
+
+class HashingUnavailable(Exception):
+    """
+    Raised when the hashing pool is full or a job didn't finish in time. Views answer it with a 503.
+    """
+    pass
+
+
+def _make_password(raw_password):
+    return hashers.make_password(raw_password)
+
+
+def _check_password(raw_password, encoded):
+    """
+    Returns whether the password matches, and a new hash if the stored one uses outdated hasher settings.
+    """
+    updated = []
+    valid = hashers.check_password(raw_password, encoded, setter=lambda raw: updated.append(_make_password(raw)))
+    return valid, updated[0] if updated else None
+
+
+def _call(func, args):
+    # Exceptions are handed back rather than raised, so the pool always runs the callback that frees the job's slot
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+class HashingExecutor(object):
+    """
+    Runs password hashing in a pool of `processes` worker processes, keeping it off request threads. At most
+    `max_pending` jobs may be queued or running; past that, and for jobs that take longer than `timeout` seconds,
+    `HashingUnavailable` is raised instead of tying up another request thread.
+    """
+
+    def __init__(self, processes, max_pending=None, timeout=None):
+        self.processes = processes
+        self.max_pending = max_pending or processes * 4
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def get_pool(self):
+        with self._lock:
+            # Pools don't survive a fork, e.g. of a preloading gunicorn master, so each process starts its own
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.processes)
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+                self._pid = os.getpid()
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+                self._pool.join()
+            self._pool = None
+
+    def run(self, func, *args):
+        pool = self.get_pool()
+        slots = self._slots
+        if not slots.acquire(False):
+            raise HashingUnavailable("Too many password hashing jobs pending")
+        try:
+            result = pool.apply_async(_call, (func, args), callback=lambda value: slots.release())
+        except Exception:
+            slots.release()
+            raise
+        try:
+            ok, value = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            raise HashingUnavailable("Password hashing timed out")
+        if not ok:
+            raise value
+        return value
+
+    def make_password(self, raw_password):
+        return self.run(_make_password, raw_password)
+
+    def check_password(self, raw_password, encoded):
+        return self.run(_check_password, raw_password, encoded)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the shared executor, or None if `SKY_HASHING_PROCESSES` isn't set and hashing stays in-process.
+    """
+    global _executor
+    if not HASHING_PROCESSES:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = HashingExecutor(HASHING_PROCESSES, HASHING_MAX_PENDING, HASHING_TIMEOUT)
+        return _executor
+
+
+def set_password(user, raw_password):
+    """
+    Like `user.set_password()`, but hashes in the executor when there is one.
+    """
+    executor = get_executor()
+    if executor is None:
+        user.set_password(raw_password)
+        return
+    user.password = executor.make_password(raw_password)
+    user._password = raw_password
+
+
+def password_changed(user, raw_password):
+    """
+    Tell the password validators (Django 1.9+) that `user`, already saved, has a new password. Does nothing when
+    `user.save()` already did.
+    """
+    if password_validation is None or getattr(user, '_password', None) is None:
+        return
+    password_validation.password_changed(raw_password, user)
+    user._password = None
+
+
+def check_password(user, raw_password):
+    """
+    Like `user.check_password()`, including upgrading outdated hashes, but hashes in the executor when there is one.
+    """
+    executor = get_executor()
+    if executor is None:
+        return user.check_password(raw_password)
+    if not user.password or not hashers.is_password_usable(user.password):
+        return False
+    valid, updated = executor.check_password(raw_password, user.password)
+    if updated:
+        user.password = updated
+        user.save(update_fields=['password'])
+    return valid
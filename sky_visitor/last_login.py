@@ -0,0 +1,153 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import atexit
+import threading
+
+from django.contrib.auth import get_user_model, models as auth_models
+from django.contrib.auth.signals import user_logged_in
+from django.db import connection, models
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from sky_visitor.cache import get_cache, last_login_key, user_key
+from sky_visitor.config import LAST_LOGIN_FLUSH_INTERVAL, LAST_LOGIN_BATCH_SIZE
+
+
+# How long other processes can see a pending last_login, in case the process holding it dies before writing it
+PENDING_TIMEOUT = 24 * 60 * 60
+
+
+def write_last_logins(entries):
+    """
+    Write `{user_id: last_login}` in one UPDATE. A user's last_login never moves back, since another process may
+    already have written a later login.
+    """
+    get_user_model()._default_manager.filter(pk__in=entries.keys()).update(last_login=Case(
+        *[When(Q(pk=pk) & (Q(last_login__isnull=True) | Q(last_login__lt=last_login)), then=Value(last_login))
+          for pk, last_login in entries.items()],
+        default=F('last_login'),
+        output_field=models.DateTimeField()
+    ))
+
+
+class LastLoginBuffer(object):
+    """
+    Collects last_login timestamps and writes them in one UPDATE once `batch_size` users are waiting or, at the
+    latest, `flush_interval` seconds after the first one came in.
+
+    Pending timestamps are also put in the cache, so that `flush_user()` in any process can write them.
+    """
+
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, user_id, last_login):
+        get_cache().set(last_login_key(user_id), last_login, PENDING_TIMEOUT)
+        with self._lock:
+            self.pending[user_id] = last_login
+            full = len(self.pending) >= self.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self, user_ids=None):
+        """
+        Write the pending timestamps, or only those of `user_ids`. Returns the timestamps written, by user id.
+        """
+        with self._lock:
+            if user_ids is None:
+                entries, self.pending = self.pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            else:
+                entries = dict((pk, self.pending.pop(pk)) for pk in user_ids if pk in self.pending)
+        if not entries:
+            return entries
+        try:
+            write_last_logins(entries)
+        except Exception:
+            with self._lock:
+                for pk, last_login in entries.items():
+                    self.pending.setdefault(pk, last_login)
+            raise
+        # The UPDATE doesn't send post_save, so drop the users from CachedUserBackend's cache here. Shared entries are
+        # dropped unless another process has put a later login there since.
+        cache = get_cache()
+        shared = cache.get_many([last_login_key(pk) for pk in entries])
+        cache.delete_many([user_key(pk) for pk in entries] +
+                          [last_login_key(pk) for pk in entries if shared.get(last_login_key(pk)) == entries[pk]])
+        return entries
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+
+buffer = LastLoginBuffer(LAST_LOGIN_FLUSH_INTERVAL, LAST_LOGIN_BATCH_SIZE)
+atexit.register(buffer.flush)
+
+
+def update_last_login(sender, user, **kwargs):
+    """
+    Replacement for django.contrib.auth's receiver of the same name, which saves the user on every login.
+    """
+    user.last_login = timezone.now()
+    buffer.add(user.pk, user.last_login)
+
+
+def flush_user(user):
+    """
+    Write a user's pending last_login now, including one buffered by another process. Call before making a token
+    that hashes last_login, so the token still matches once every process has flushed.
+
+    Logins buffered elsewhere are only seen through a cache shared by all processes.
+    """
+    UserModel = get_user_model()
+    if not isinstance(user, UserModel):
+        return
+    cache = get_cache()
+    key = last_login_key(user.pk)
+    shared = cache.get(key)
+    written = buffer.flush([user.pk])
+    if shared is None and not written:
+        return
+    if shared is not None and shared != written.get(user.pk):
+        # Buffered by another process, which will write it again later. That's a no-op as last_login never moves back.
+        write_last_logins({user.pk: shared})
+        cache.delete_many([key, user_key(user.pk)])
+    user.last_login = UserModel._default_manager.filter(pk=user.pk).values_list('last_login', flat=True)[0]
+
+
+def install():
+    user_logged_in.disconnect(auth_models.update_last_login)
+    user_logged_in.disconnect(dispatch_uid='update_last_login')
+    user_logged_in.connect(update_last_login, dispatch_uid='sky_visitor.update_last_login')
+
+
+def uninstall():
+    user_logged_in.disconnect(dispatch_uid='sky_visitor.update_last_login')
+    buffer.flush()
+    user_logged_in.connect(auth_models.update_last_login, dispatch_uid='update_last_login')
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from sky_visitor.config import HASHING_PROCESSES
+
+# Attributes that set the work factor of the hashers that have one, and whether it grows linearly (PBKDF2
+# iterations, Argon2 time cost) or doubles with every step (bcrypt rounds)
+WORK_FACTORS = [('iterations', True), ('time_cost', True), ('rounds', False)]
+
+
+def get_work_factor(hasher):
+    for attr, linear in WORK_FACTORS:
+        if hasattr(hasher, attr):
+            return attr, linear
+    return None, None
+
+
+def time_login(args):
+    """
+    Time one password check, which is what a login costs, at the given work factor. Runs in a worker process.
+    """
+    path, attr, factor = args
+    hasher = import_string(path)()
+    setattr(hasher, attr, factor)
+    encoded = hasher.encode('calibration password', hasher.salt())
+    start = time.time()
+    hasher.verify('calibration password', encoded)
+    return time.time() - start
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class Command(BaseCommand):
+    help = "Time the configured password hashers on this host and recommend work factors for a login latency budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hasher', action='append', dest='hashers', default=None,
+                            help="Dotted path of a hasher to calibrate. Repeatable. Defaults to PASSWORD_HASHERS.")
+        parser.add_argument('--factors', default=None,
+                            help="Comma separated work factors to try. Defaults to a range around the current one.")
+        parser.add_argument('--concurrency', type=int, default=HASHING_PROCESSES or multiprocessing.cpu_count(),
+                            help="Number of logins hashed at once, e.g. the number of worker processes or threads "
+                                 "serving LoginView. Defaults to SKY_HASHING_PROCESSES, or the number of CPUs.")
+        parser.add_argument('--samples', type=int, default=10,
+                            help="Logins timed per worker at each work factor.")
+        parser.add_argument('--target-ms', type=float, default=250,
+                            help="Login latency budget, in milliseconds, that the p99 should stay under.")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        samples = max(1, options['samples'])
+        target = options['target_ms'] / 1000.0
+        try:
+            factors = [int(f) for f in options['factors'].split(',')] if options['factors'] else None
+        except ValueError:
+            raise CommandError("--factors must be a comma separated list of integers")
+
+        self.stdout.write("Timing %d concurrent logins, %d samples each, against a p99 budget of %dms" %
+                          (concurrency, samples, options['target_ms']))
+        pool = multiprocessing.Pool(concurrency)
+        try:
+            for path in options['hashers'] or settings.PASSWORD_HASHERS:
+                self.calibrate(pool, path, factors, concurrency * samples, target)
+        finally:
+            pool.close()
+            pool.join()
+
+    def calibrate(self, pool, path, factors, jobs, target):
+        hasher = import_string(path)()
+        attr, linear = get_work_factor(hasher)
+        self.stdout.write("")
+        if attr is None:
+            self.stdout.write("%s: no work factor to tune, skipped" % path)
+            return
+        current = getattr(hasher, attr)
+        if not factors:
+            if linear:
+                factors = [max(1, int(current * scale)) for scale in (0.25, 0.5, 1, 2, 4)]
+            else:
+                factors = [f for f in range(current - 2, current + 3) if f > 0]
+
+        self.stdout.write("%s (%s, currently %d):" % (path, attr, current))
+        best = None
+        for factor in factors:
+            try:
+                timings = pool.map(time_login, [(path, attr, factor)] * jobs, chunksize=1)
+            except ValueError as e:
+                # The hasher's library isn't installed
+                self.stdout.write("  skipped: %s" % e)
+                return
+            p50, p99 = percentile(timings, 50), percentile(timings, 99)
+            within = p99 <= target
+            self.stdout.write("  %s=%-10d p50 %8.1fms  p99 %8.1fms%s" %
+                              (attr, factor, p50 * 1000, p99 * 1000, "" if within else "  over budget"))
+            if within and (best is None or factor > best[0]):
+                best = (factor, p99)
+
+        if best is None:
+            self.stdout.write("  Recommended: none of these fit the budget, try lower %s or fewer concurrent logins" %
+                              attr)
+            return
+        factor, p99 = best
+        if linear and factor == max(factors):
+            # Cost is linear in the factor, so the budget left over can be spent
+            factor = max(factor, int(factor * target / p99))
+        self.stdout.write("  Recommended: %s = %d" % (attr, factor))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from sky_visitor.models import InvitedUser
+from sky_visitor.utils import Encryption
+
+
+class Command(BaseCommand):
+    help = "Rewrite InvitedUser.enc_password values that are still stored in the old pickle+hex format."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of invitations read and rewritten per transaction.")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Only count the invitations that would be rewritten.")
+
+    def handle(self, *args, **options):
+        legacy = InvitedUser.objects.filter(enc_password__isnull=False).exclude(enc_password='') \
+            .exclude(enc_password__startswith=Encryption.FORMAT_PREFIX)
+
+        if options['dry_run']:
+            self.stdout.write("%d invitations to rewrite" % legacy.count())
+            return
+
+        rewritten = 0
+        last_id = 0
+        while True:
+            # Walk the primary key instead of using OFFSET so every chunk is an index range scan
+            chunk = list(legacy.filter(id__gt=last_id).order_by('id')
+                         .only('id', 'email', 'enc_password')[:options['chunk_size']])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for invited_user in chunk:
+                    password = invited_user.decrypt_password()
+                    InvitedUser.objects.filter(id=invited_user.id, enc_password=invited_user.enc_password) \
+                        .update(enc_password=invited_user.encrypt_password(password))
+            rewritten += len(chunk)
+            last_id = chunk[-1].id
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Rewrote %d invitations" % rewritten)
+
+        if int(options['verbosity']) > 0:
+            self.stdout.write("Rewrote %d invitations" % rewritten)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from sky_visitor.config import EMAIL_OUTBOX_BATCH_SIZE, EMAIL_OUTBOX_CONCURRENCY, EMAIL_OUTBOX_MAX_ATTEMPTS, \
+    EMAIL_OUTBOX_RETRY_DELAY
+from sky_visitor.models import EmailOutbox
+from sky_visitor.template_email_senders import SMTPPool
+
+
+class Command(BaseCommand):
+    help = "Deliver emails queued in the sky_visitor EmailOutbox (see SKY_EMAIL_OUTBOX)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=EMAIL_OUTBOX_BATCH_SIZE,
+                            help="Number of messages claimed at a time.")
+        parser.add_argument('--concurrency', type=int, default=EMAIL_OUTBOX_CONCURRENCY,
+                            help="Number of messages sent in parallel.")
+        parser.add_argument('--max-attempts', type=int, default=EMAIL_OUTBOX_MAX_ATTEMPTS,
+                            help="Give up on a message after this many failed attempts.")
+        parser.add_argument('--retry-delay', type=int, default=EMAIL_OUTBOX_RETRY_DELAY,
+                            help="Seconds before the first retry. Doubles after every further failure.")
+        parser.add_argument('--poll-interval', type=float, default=5,
+                            help="Seconds to wait when the outbox is empty.")
+        parser.add_argument('--once', action='store_true', default=False,
+                            help="Exit once the outbox has no more due messages instead of polling.")
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help="Print the queue depth and send latency and exit.")
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.print_stats()
+            return
+
+        pool = SMTPPool(max(1, options['concurrency']), max_in_flight=max(1, options['batch_size']))
+        try:
+            while True:
+                processed = self.process_batch(pool, options)
+                if not processed:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        finally:
+            pool.close()
+
+        if int(options['verbosity']) > 1:
+            self.print_stats()
+
+    def process_batch(self, pool, options):
+        messages = EmailOutbox.objects.claim(options['batch_size'])
+        if not messages:
+            return 0
+
+        # The pool's threads keep their connections open from one batch to the next. They only talk SMTP, all
+        # database writes happen here on the main thread.
+        pending = [(message, pool.submit(message.to_message())) for message in messages]
+        results = [(message, result.get()[1]) for message, result in pending]
+
+        sent_ids = []
+        for message, error in results:
+            if error is None:
+                sent_ids.append(message.id)
+            else:
+                EmailOutbox.objects.mark_failed(message, error, max_attempts=options['max_attempts'],
+                                                retry_delay=options['retry_delay'])
+                if int(options['verbosity']) > 0:
+                    self.stderr.write("Failed to send outbox message %s: %s" % (message.id, error))
+        EmailOutbox.objects.mark_sent(sent_ids)
+
+        if int(options['verbosity']) > 1:
+            self.stdout.write("Sent %d of %d messages" % (len(sent_ids), len(messages)))
+        return len(messages)
+
+    def print_stats(self):
+        self.stdout.write("Queue depth: %d" % EmailOutbox.objects.queue_depth())
+        latency = EmailOutbox.objects.send_latency()
+        if latency is None:
+            self.stdout.write("Send latency: n/a")
+        else:
+            self.stdout.write("Send latency: %.2fs average, %.2fs max" % latency)
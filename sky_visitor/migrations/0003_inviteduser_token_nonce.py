@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 14:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import sky_visitor.utils
+
+
+def set_token_nonces(apps, schema_editor):
+    # AddField computes a callable default once, so every existing invitation starts with the same nonce
+    InvitedUser = apps.get_model('sky_visitor', 'InvitedUser')
+    for pk in InvitedUser.objects.values_list('pk', flat=True).iterator():
+        InvitedUser.objects.filter(pk=pk).update(token_nonce=sky_visitor.utils.make_token_nonce())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sky_visitor', '0002_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inviteduser',
+            name='token_nonce',
+            field=models.CharField(blank=True, default=sky_visitor.utils.make_token_nonce, max_length=32),
+        ),
+        migrations.RunPython(set_token_nonces, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+def get_index(apps, schema_editor):
+    UserModel = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    table = UserModel._meta.db_table
+    column = UserModel._meta.get_field('email').column
+    return schema_editor.quote_name('%s_email_upper_idx' % table), schema_editor.quote_name(table), \
+        schema_editor.quote_name(column)
+
+
+def concurrently(schema_editor):
+    # Django < 1.10 ignores Migration.atomic and always wraps the migration in a transaction
+    return '' if getattr(schema_editor, 'atomic_migration', True) else 'CONCURRENTLY '
+
+
+def create_index(apps, schema_editor):
+    # Postgres can't use the plain email index for `email__iexact`, which it runs as UPPER(email::text) = UPPER(%s).
+    # Other databases either compare case insensitively already (MySQL) or have no expression indexes.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE INDEX %sIF NOT EXISTS %s ON %s (UPPER(%s::text))' %
+                          ((concurrently(schema_editor),) + get_index(apps, schema_editor)))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX %sIF EXISTS %s' % (concurrently(schema_editor), get_index(apps, schema_editor)[0]))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction, but doesn't lock the user table while it builds
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('sky_visitor', '0003_inviteduser_token_nonce'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -12,12 +12,122 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import json
+import uuid
 from django.conf import settings
-from django.db import models
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives
+from django.core.validators import validate_email
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 
 from django.utils.translation import ugettext_lazy as _
 
-from utils import Encryption, make_password
+from cache import bump_version, invalidate_cached_user, permission_version_key
+from config import BULK_INVITE_CHUNK_SIZE, EMAIL_OUTBOX_MAX_ATTEMPTS, EMAIL_OUTBOX_RETRY_DELAY, SEND_USER_PASSWORD
+from utils import Encryption, make_password, make_passwords, make_token_nonce, chunked
+
+
+class InvitedUserQuerySet(models.QuerySet):
+
+    def without_password(self):
+        return self.filter(Q(enc_password__isnull=True) | Q(enc_password=''))
+
+    def backfill_passwords(self, chunk_size=None):
+        """
+        Generate the temporary password for every invitation in this queryset that doesn't have one yet, for
+        example after turning on `SKY_SEND_USER_PASSWORD`. Returns the number of invitations updated.
+        """
+        chunk_size = chunk_size or BULK_INVITE_CHUNK_SIZE
+        missing = self.without_password()
+        updated = 0
+        last_id = 0
+        while True:
+            chunk = list(missing.filter(id__gt=last_id).order_by('id').only('id', 'email')[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for invited_user, password in zip(chunk, make_passwords(len(chunk))):
+                    updated += self.model.objects.filter(id=invited_user.id).without_password().update(
+                        enc_password=invited_user.encrypt_password(password))
+            last_id = chunk[-1].id
+        return updated
+
+
+class InvitedUserManager(models.Manager.from_queryset(InvitedUserQuerySet)):
+
+    def bulk_invite(self, invitations, chunk_size=None):
+        """
+        Invite many people at once. `invitations` is an iterable of `(email, name)` pairs.
+
+        Existing users and invitations are looked up with one `IN (...)` query per chunk instead of one query per
+        email, and new invitations are inserted with `bulk_create`. Returns a list of `(email, result)` pairs in input
+        order, where result is one of the `InvitedUser.INVITE_*` constants.
+
+        No invitation emails are sent; that's up to the caller.
+        """
+        chunk_size = chunk_size or BULK_INVITE_CHUNK_SIZE
+        UserModel = get_user_model()
+        max_length = self.model._meta.get_field('email').max_length
+        name_max_length = self.model._meta.get_field('name').max_length
+
+        report = []
+        pending = []
+        duplicates = []
+        seen = {}
+        for email, name in invitations:
+            email = (email or '').strip()
+            try:
+                validate_email(email)
+            except ValidationError:
+                report.append([email, self.model.INVITE_INVALID])
+                continue
+            if len(email) > max_length or (name and len(name) > name_max_length):
+                report.append([email, self.model.INVITE_INVALID])
+                continue
+            if email in seen:
+                # The same address twice in one batch only gets invited once. Its result is filled in below, from
+                # the first occurrence's.
+                row = [email, None]
+                report.append(row)
+                duplicates.append((row, seen[email]))
+                continue
+            row = [email, self.model.INVITE_CREATED]
+            seen[email] = row
+            report.append(row)
+            pending.append((row, name))
+
+        for chunk in chunked(pending, chunk_size):
+            emails = [row[0] for row, name in chunk]
+            existing_users = set(UserModel._default_manager.filter(email__in=emails).values_list('email', flat=True))
+            existing_invites = set(self.filter(email__in=emails).values_list('email', flat=True))
+
+            to_create = []
+            passwords = make_passwords(len(chunk)) if SEND_USER_PASSWORD else None
+            for row, name in chunk:
+                email = row[0]
+                if email in existing_users:
+                    row[1] = self.model.INVITE_ALREADY_USER
+                elif email in existing_invites:
+                    row[1] = self.model.INVITE_ALREADY_INVITED
+                else:
+                    invited_user = self.model(email=email, name=name or None)
+                    if SEND_USER_PASSWORD:
+                        # bulk_create() skips save(), so fill in what save() would have
+                        invited_user.enc_password = invited_user.encrypt_password(next(passwords))
+                    to_create.append(invited_user)
+            self.bulk_create(to_create)
+
+        for row, first in duplicates:
+            # A repeat of an address this batch just invited is already invited; otherwise it fares like the first
+            row[1] = self.model.INVITE_ALREADY_INVITED if first[1] == self.model.INVITE_CREATED else first[1]
+
+        return [tuple(row) for row in report]
 
 
 class InvitedUser(models.Model):
@@ -27,6 +137,13 @@ class InvitedUser(models.Model):
         (STATUS_INVITED, "Invited"),
         (STATUS_REGISTERED, "Registered"),
     )
+
+    # Per-row results of InvitedUser.objects.bulk_invite()
+    INVITE_CREATED = 'created'
+    INVITE_ALREADY_USER = 'already-user'
+    INVITE_ALREADY_INVITED = 'already-invited'
+    INVITE_INVALID = 'invalid'
+
     email = models.EmailField(max_length=254, unique=True, error_messages={
         u"unique": _(u"Invitation to registration already sended.")
     })
@@ -34,8 +151,12 @@ class InvitedUser(models.Model):
     created_user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
     name = models.CharField(max_length=256, null=True, blank=True)
     enc_password = models.CharField(max_length=256, null=True, blank=True)
+    # Hashed into invitation tokens, see sky_visitor.tokens.InvitationTokenGenerator
+    token_nonce = models.CharField(max_length=32, blank=True, default=make_token_nonce)
+
+    objects = InvitedUserManager()
 
-    # We need to fake a few properties so we can use the default token generation code
+    # Fake a few properties so django's default token generator can still be used for invitations
     @property
     def last_login(self):
         if self.created_user and hasattr(self.created_user, 'last_login'):
@@ -48,10 +169,27 @@ class InvitedUser(models.Model):
         return ''
 
     def save(self, *args, **kwargs):
-        if not self.enc_password:
+        # Without SKY_SEND_USER_PASSWORD nothing reads the temporary password, so it's only generated on demand by
+        # get_password()
+        if SEND_USER_PASSWORD and not self.enc_password:
             self.enc_password = self.encrypt_password(make_password())
         super(InvitedUser, self).save(*args, **kwargs)
 
+    def get_password(self):
+        """
+        Return the temporary password, generating and storing it first if this invitation doesn't have one yet.
+        """
+        if not self.enc_password:
+            enc_password = self.encrypt_password(make_password())
+            if self.pk is None:
+                self.enc_password = enc_password
+            elif InvitedUser.objects.filter(pk=self.pk).without_password().update(enc_password=enc_password):
+                self.enc_password = enc_password
+            else:
+                # Someone else generated it first
+                self.enc_password = InvitedUser.objects.values_list('enc_password', flat=True).get(pk=self.pk)
+        return self.decrypt_password()
+
     def get_encrypter(self):
         enc = Encryption(key="%s_%s" % (self.email, settings.SECRET_KEY))
         return enc
@@ -62,3 +200,135 @@ class InvitedUser(models.Model):
     def encrypt_password(self, password):
         return self.get_encrypter().encrypt(password)
 
+
+class EmailOutboxManager(models.Manager):
+
+    def enqueue(self, message):
+        """
+        Store a rendered `EmailMessage` to be delivered later by `manage.py sky_visitor_outbox_worker`.
+
+        The row is written in the caller's transaction, so the worker only sees it once that transaction commits
+        and never sees it if it rolls back.
+        """
+        html_body = ''
+        for content, mimetype in getattr(message, 'alternatives', []):
+            if mimetype == 'text/html':
+                html_body = content
+        return self.create(to_address=json.dumps(list(message.to)), from_email=message.from_email or '',
+                           subject=message.subject, body=message.body, html_body=html_body)
+
+    def claim(self, batch_size, lease_seconds=300):
+        """
+        Claim up to `batch_size` due messages for this worker. Claimed messages aren't due again until the lease
+        expires, so messages held by a worker that died get picked up by another one.
+        """
+        now = timezone.now()
+        due_ids = list(self.filter(status=self.model.STATUS_PENDING, next_attempt_at__lte=now)
+                       .order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+        if not due_ids:
+            return []
+        token = uuid.uuid4().hex
+        self.filter(id__in=due_ids, status=self.model.STATUS_PENDING, next_attempt_at__lte=now).update(
+            claimed_by=token, next_attempt_at=now + datetime.timedelta(seconds=lease_seconds))
+        return list(self.filter(claimed_by=token))
+
+    def mark_sent(self, ids):
+        self.filter(id__in=ids).update(status=self.model.STATUS_SENT, sent_at=timezone.now(), claimed_by='',
+                                       attempts=F('attempts') + 1)
+
+    def mark_failed(self, message, error, max_attempts=None, retry_delay=None):
+        max_attempts = max_attempts or EMAIL_OUTBOX_MAX_ATTEMPTS
+        retry_delay = retry_delay or EMAIL_OUTBOX_RETRY_DELAY
+        attempts = message.attempts + 1
+        update = {'attempts': attempts, 'last_error': error, 'claimed_by': ''}
+        if attempts >= max_attempts:
+            update['status'] = self.model.STATUS_FAILED
+        else:
+            delay = retry_delay * 2 ** (attempts - 1)
+            update['next_attempt_at'] = timezone.now() + datetime.timedelta(seconds=delay)
+        self.filter(id=message.id).update(**update)
+
+    def queue_depth(self):
+        return self.filter(status=self.model.STATUS_PENDING).count()
+
+    def send_latency(self, sample_size=1000):
+        """
+        Return `(average, maximum)` seconds between queueing and delivery over the most recently sent messages, or
+        `None` if nothing has been sent yet.
+        """
+        rows = self.filter(status=self.model.STATUS_SENT).order_by('-sent_at').values_list(
+            'created_at', 'sent_at')[:sample_size]
+        latencies = [(sent_at - created_at).total_seconds() for created_at, sent_at in rows]
+        if not latencies:
+            return None
+        return sum(latencies) / len(latencies), max(latencies)
+
+
+class EmailOutbox(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_SENT, "Sent"),
+        (STATUS_FAILED, "Failed"),
+    )
+    to_address = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    subject = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=32, default=STATUS_PENDING, choices=STATUS_CHOICES)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EmailOutboxManager()
+
+    class Meta:
+        index_together = [('status', 'next_attempt_at')]
+
+    def get_recipients(self):
+        return json.loads(self.to_address)
+
+    def to_message(self, connection=None):
+        msg = EmailMultiAlternatives(subject=self.subject, body=self.body, from_email=self.from_email or None,
+                                     to=self.get_recipients(), connection=connection)
+        if self.html_body:
+            msg.attach_alternative(self.html_body, "text/html")
+        return msg
+
+
+# Connected without a sender, since the user model may not be loaded yet when this module is imported
+@receiver(post_save, dispatch_uid='sky_visitor.invalidate_cached_user.save')
+@receiver(post_delete, dispatch_uid='sky_visitor.invalidate_cached_user.delete')
+def invalidate_cached_user_on_change(sender, instance, **kwargs):
+    if isinstance(instance, get_user_model()):
+        invalidate_cached_user(instance.pk)
+
+
+@receiver(m2m_changed, dispatch_uid='sky_visitor.bump_permission_version')
+def bump_permission_version(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    UserModel = get_user_model()
+    user_m2m = [getattr(UserModel, name).through for name in ('groups', 'user_permissions') if hasattr(UserModel, name)]
+    if sender in user_m2m:
+        if not reverse:
+            bump_version(permission_version_key(instance.pk))
+        elif pk_set is not None:
+            for pk in pk_set:
+                bump_version(permission_version_key(pk))
+        else:
+            # group.user_set.clear() doesn't say which users it removed
+            bump_version(permission_version_key())
+    elif sender is Group.permissions.through:
+        bump_version(permission_version_key())
+
+
+@receiver(post_delete, sender=Group, dispatch_uid='sky_visitor.bump_permission_version.group')
+def bump_permission_version_on_group_delete(sender, **kwargs):
+    bump_version(permission_version_key())
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+from django.contrib.auth import get_user_model
+
 from forms import InvitationStartForm
+from models import InvitedUser
 
 
 def create_invitation(email, name):
@@ -8,3 +11,19 @@ def create_invitation(email, name):
         return form.save()
     return None
 
+
+def create_invitations(invitations):
+    """
+    Bulk version of `create_invitation`. Takes an iterable of `(email, name)` pairs and returns a list of
+    `(email, result)` pairs, see `InvitedUser.objects.bulk_invite()`.
+    """
+    return InvitedUser.objects.bulk_invite(invitations)
+
+
+def get_users_by_email(email, **filters):
+    """
+    Users whose email matches `email` regardless of case. On Postgres this uses the UPPER(email) index created by
+    sky_visitor's migrations instead of scanning the user table.
+    """
+    UserModel = get_user_model()
+    return UserModel._default_manager.filter(email__iexact=email.strip(), **filters)
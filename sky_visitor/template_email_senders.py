@@ -1,32 +1,253 @@
 # -*- coding: utf-8 -*-
+import logging
+import os
+import smtplib
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.template import Template, Context, loader, TemplateDoesNotExist
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.template.defaultfilters import striptags
 
+from sky_visitor.utils import chunked, LRUCache
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+logger = logging.getLogger(__name__)
+
+# Cached in place of templates that don't exist
+TEMPLATE_MISSING = object()
+
+# Errors after which a message is sent again over a new connection. Anything else, such as a refused recipient or an
+# error after the relay accepted the message, would fail again or send a duplicate.
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def send_messages(messages, batch_size=100, connection=None):
+    """
+    Send already built `EmailMessage`s, reusing one connection for up to `batch_size` messages instead of connecting
+    once per message. If the connection was lost, it is reopened and the message retried once.
+
+    Returns a list of `(message, error)` pairs in input order, where `error` is None for messages that were sent.
+    """
+    connection = connection or get_connection()
+    results = []
+    for batch in chunked(list(messages), batch_size):
+        try:
+            connection.open()
+        except Exception:
+            # send_messages() will try again and report the error per message
+            pass
+        try:
+            for message in batch:
+                results.append((message, _send_with_reconnect(connection, message)))
+        finally:
+            connection.close()
+    return results
+
+
+def _send_with_reconnect(connection, message, log_errors=True):
+    try:
+        try:
+            connection.send_messages([message])
+        except RECONNECT_ERRORS:
+            # The relay may have dropped an idle connection
+            connection.close()
+            connection.open()
+            connection.send_messages([message])
+    except Exception as e:
+        if log_errors:
+            logger.exception("Failed to send email to %s", ', '.join(message.to))
+        connection.close()
+        return '%s: %s' % (e.__class__.__name__, e)
+    return None
+
+
+class SMTPPool(object):
+    """
+    Sends messages from `size` worker threads, each of which keeps its own connection to the mail server open between
+    messages instead of connecting for every email. At most `max_in_flight` messages are queued or being sent at
+    once; `submit()` blocks until there is room.
+    """
+
+    def __init__(self, size=4, max_in_flight=100):
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _start(self):
+        with self._lock:
+            # Threads don't survive a fork, so each process starts its own
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.size)
+                self._slots = threading.BoundedSemaphore(self.max_in_flight)
+                self._local = threading.local()
+                self._connections = []
+                self._pid = os.getpid()
+            return self._pool
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = get_connection()
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _deliver(self, message):
+        try:
+            connection = self._get_connection()
+            try:
+                # No-op while the connection is still open. Without it every send would connect and disconnect.
+                connection.open()
+            except Exception:
+                # _send_with_reconnect() will try again and report the error
+                pass
+            # Logged by _delivered(), which also sees the errors raised outside of sending
+            return message, _send_with_reconnect(connection, message, log_errors=False)
+        except Exception as e:
+            return message, '%s: %s' % (e.__class__.__name__, e)
+
+    def _delivered(self, slots, result):
+        slots.release()
+        message, error = result
+        if error is not None:
+            logger.error("Failed to send email to %s: %s", ', '.join(message.to), error)
+
+    def submit(self, message):
+        """
+        Queue an `EmailMessage`. Returns an `AsyncResult` whose `get()` gives `(message, error)`, where `error` is
+        None if the message was sent.
+        """
+        pool = self._start()
+        slots = self._slots
+        slots.acquire()
+        try:
+            return pool.apply_async(self._deliver, (message,),
+                                    callback=lambda result: self._delivered(slots, result))
+        except Exception:
+            slots.release()
+            raise
+
+    def close(self):
+        """
+        Wait for the queued messages to be sent, then close the connections and stop the threads.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            if pool is None or self._pid != os.getpid():
+                return
+            connections = self._connections
+        pool.close()
+        pool.join()
+        for connection in connections:
+            connection.close()
+
 
 class BaseTemplateSender(object):
+    def build_message(self, template_name, to_address, text_template_name=None,
+                      subject='', context=None, from_email=None, **kwargs):
+        """
+        Render a message without sending it. Used to queue messages in the email outbox, so senders that don't
+        implement it can only send right away.
+        """
+        raise ImproperlyConfigured("%s doesn't implement build_message(), which the email outbox needs to queue "
+                                   "emails." % self.__class__.__name__)
+
+    @classmethod
+    def can_build_messages(cls):
+        build_message = getattr(cls.build_message, '__func__', cls.build_message)
+        return build_message is not getattr(BaseTemplateSender.build_message, '__func__',
+                                            BaseTemplateSender.build_message)
+
     def send(self, template_name, to_address, text_template_name=None,
              subject='', context=None, from_email=None, **kwargs):
         pass
 
+    def send_many(self, messages, batch_size=None):
+        """
+        Send several messages. `messages` is an iterable of dicts of `send()` keyword arguments.
+
+        Returns a list of `(recipient, sent, error)` tuples, one for every recipient of every message, where `error`
+        describes why a message wasn't sent.
+        """
+        results = []
+        for kwargs in messages:
+            to_address = kwargs['to_address']
+            if isinstance(to_address, (str, unicode)):
+                to_address = (to_address,)
+            error = None
+            try:
+                if not self.send(**kwargs):
+                    error = "Not sent"
+            except Exception as e:
+                logger.exception("Failed to send email to %s", ', '.join(to_address))
+                error = '%s: %s' % (e.__class__.__name__, e)
+            results.extend((recipient, error is None, error) for recipient in to_address)
+        return results
+
 
 class DjangoTemplateSender(BaseTemplateSender):
+    # Messages sent over one SMTP connection by send_many() before reconnecting
+    batch_size = 100
+
+    # Compiled templates and subjects, shared by all senders in the process. Templates that don't exist are cached
+    # too, so a missing text template doesn't search every template directory for every email. Not used when DEBUG
+    # is on so template changes show up right away.
+    template_cache = LRUCache(maxsize=256)
+
+    def _get_cached(self, key, load):
+        if settings.DEBUG:
+            return load()
+        t = self.template_cache.get(key)
+        if t is None:
+            try:
+                t = load()
+            except TemplateDoesNotExist:
+                t = TEMPLATE_MISSING
+            self.template_cache.set(key, t)
+        if t is TEMPLATE_MISSING:
+            raise TemplateDoesNotExist(key[1])
+        return t
+
+    def get_template(self, template_name):
+        return self._get_cached(('name', template_name), lambda: loader.get_template(template_name))
+
+    def get_template_from_string(self, s):
+        return self._get_cached(('source', s), lambda: Template(s))
+
     def render(self, template_name, context):
-        t = loader.get_template(template_name)
+        t = self.get_template(template_name)
         return t.render(Context(context))
 
     def _render_from_string(self, s, context):
-        t = Template(s)
+        t = self.get_template_from_string(s)
         return t.render(Context(context))
 
-    def send(self, template_name, to_address, text_template_name=None,
-             subject='', context=None, from_email=None, **kwargs):
+    def build_message(self, template_name, to_address, text_template_name=None,
+                      subject='', context=None, from_email=None, **kwargs):
         context = context or {}
         html_body = self.render(template_name, context)
-        try:
-            text_body = self.render(text_template_name, context)
-        except TemplateDoesNotExist:
+        text_body = None
+        if text_template_name:
+            try:
+                text_body = self.render(text_template_name, context)
+            except TemplateDoesNotExist:
+                pass
+        if text_body is None:
             text_body = striptags(html_body)
 
         subject = self._render_from_string(subject, context)
@@ -36,9 +257,122 @@ class DjangoTemplateSender(BaseTemplateSender):
         msg = EmailMultiAlternatives(subject=subject, body=text_body,
             from_email=from_email, to=to_address)
         msg.attach_alternative(html_body, "text/html")
+        return msg
+
+    def send(self, template_name, to_address, text_template_name=None,
+             subject='', context=None, from_email=None, **kwargs):
+        msg = self.build_message(template_name, to_address, text_template_name=text_template_name,
+                                 subject=subject, context=context, from_email=from_email, **kwargs)
         return msg.send()
 
+    def send_many(self, messages, batch_size=None):
+        """
+        Render every message up front and send them all over a shared connection.
+        """
+        built = [self.build_message(**kwargs) for kwargs in messages]
+        results = []
+        for msg, error in send_messages(built, batch_size=batch_size or self.batch_size):
+            results.extend((recipient, error is None, error) for recipient in msg.to)
+        return results
+
+
+class AsyncTemplateSender(DjangoTemplateSender):
+    """
+    Renders emails in the calling thread but sends them in the background over the kept-open connections of an
+    `SMTPPool`, so callers don't wait to connect to the mail server. `send()` returns right away with an `AsyncResult`
+    (see `SMTPPool.submit()`); failures are logged whether or not anyone calls its `get()`. `send_many()` queues every
+    message at once and waits until they have all been sent.
 
+    Enable with `SKY_TEMPLATE_EMAIL_SENDER = 'sky_visitor.template_email_senders.AsyncTemplateSender'`.
+    """
+    # Shared by all senders in the process that aren't given a pool of their own
+    default_pool = SMTPPool()
 
+    def __init__(self, pool=None):
+        self.pool = pool or self.default_pool
+
+    def send_message(self, message):
+        return self.pool.submit(message)
+
+    def send(self, template_name, to_address, text_template_name=None,
+             subject='', context=None, from_email=None, **kwargs):
+        msg = self.build_message(template_name, to_address, text_template_name=text_template_name,
+                                 subject=subject, context=context, from_email=from_email, **kwargs)
+        return self.send_message(msg)
+
+    def send_many(self, messages, batch_size=None):
+        pending = [self.send_message(self.build_message(**kwargs)) for kwargs in messages]
+        results = []
+        for result in pending:
+            msg, error = result.get()
+            results.extend((recipient, error is None, error) for recipient in msg.to)
+        return results
+
+
+class Jinja2TemplateSender(DjangoTemplateSender):
+    """
+    Renders emails with Jinja2 instead of the Django template engine. Enable with
+    `SKY_TEMPLATE_EMAIL_SENDER = 'sky_visitor.template_email_senders.Jinja2TemplateSender'`.
+
+    Templates are looked up by the same names in `TEMPLATE_DIRS` and the `templates` directory of every installed app.
+    All senders share one `Environment`, and compiled templates are also kept in a filesystem bytecode cache so new
+    processes don't have to parse them again.
+    """
+    # Directory for the bytecode cache. Defaults to the system temp directory.
+    bytecode_cache_dir = None
+    # Subjects and text templates are plain text, only these get autoescaped
+    autoescape_extensions = ('.html', '.htm', '.xml')
+
+    template_cache = LRUCache(maxsize=256)
+    _environment = None
+    _environment_lock = threading.Lock()
+
+    def __init__(self):
+        if jinja2 is None:
+            raise ImproperlyConfigured("Jinja2TemplateSender requires Jinja2 to be installed.")
+
+    def get_template_dirs(self):
+        dirs = list(getattr(settings, 'TEMPLATE_DIRS', ()))
+        dirs.extend(os.path.join(app_config.path, 'templates') for app_config in apps.get_app_configs())
+        return [d for d in dirs if os.path.isdir(d)]
+
+    def get_environment(self):
+        cls = self.__class__
+        if cls._environment is None:
+            with cls._environment_lock:
+                if cls._environment is None:
+                    cls._environment = jinja2.Environment(
+                        loader=jinja2.FileSystemLoader(self.get_template_dirs()),
+                        bytecode_cache=jinja2.FileSystemBytecodeCache(self.bytecode_cache_dir),
+                        autoescape=self.should_autoescape,
+                        auto_reload=settings.DEBUG,
+                    )
+        return cls._environment
+
+    def should_autoescape(self, template_name):
+        return template_name is not None and template_name.endswith(self.autoescape_extensions)
+
+    def get_template(self, template_name):
+        def load():
+            try:
+                return self.get_environment().get_template(template_name)
+            except jinja2.TemplateNotFound:
+                raise TemplateDoesNotExist(template_name)
+        return self._get_cached(('name', template_name), load)
+
+    def get_template_from_string(self, s):
+        return self._get_cached(('source', s), lambda: self.get_environment().from_string(s))
+
+    def render(self, template_name, context):
+        return self.get_template(template_name).render(context)
+
+    def _render_from_string(self, s, context):
+        return self.get_template_from_string(s).render(context)
 
 
+@receiver(setting_changed)
+def clear_template_cache(**kwargs):
+    if kwargs['setting'] in ('DEBUG', 'TEMPLATES', 'TEMPLATE_DIRS', 'TEMPLATE_LOADERS'):
+        DjangoTemplateSender.template_cache.clear()
+        Jinja2TemplateSender.template_cache.clear()
+        Jinja2TemplateSender._environment = None
@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncore
+import smtpd
+import threading
 
 from django.test import TestCase
 
@@ -25,3 +28,48 @@ class SkyVisitorTestCase(TestCase):
     def assertRedirected(self, response, expected_url, status_code=302):
         self.assertEqual(response.status_code, status_code)
         self.assertEqual(response._headers['location'][1], 'http://testserver%s' % expected_url)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+    A mail server on a free local port that keeps what it receives in `messages`, for testing real SMTP delivery.
+    Runs in a background thread between `start()` and `stop()`.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self.channels = []
+        self._running = False
+
+    def handle_accept(self):
+        # SMTPServer.handle_accept(), keeping the channel so that stop() can close it
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.connections += 1
+            self.channels.append(smtpd.SMTPChannel(self, conn, addr))
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        # Channels clients didn't close stay in asyncore's global socket_map otherwise
+        for channel in self.channels:
+            channel.close()
+        self.close()
@@ -0,0 +1,134 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+from django.conf import settings
+from django.utils import six
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.contrib.auth.tokens import default_token_generator
+from django.utils.http import base36_to_int, int_to_base36
+
+from sky_visitor.config import INVITATION_TTL
+
+
+class SignedTokenGenerator(object):
+    """
+    Token generator that can reject bad links before loading the user.
+
+    Tokens look like `<issued>-<signature><state>`: the base36 issue time in seconds, an HMAC of the purpose, user id
+    and issue time, and an HMAC of the user's current state. `check_token_signature()` only needs the user id from the
+    URL, so expired, malformed, tampered and wrong purpose tokens are rejected without a query. `check_token()`
+    additionally checks the state, which changes once the token has been used.
+
+    Use it by setting `token_generator` on both the view that sends the email and the view that validates the link.
+    """
+    HASH_LENGTH = 10
+    key_salt = 'sky_visitor.tokens.SignedTokenGenerator'
+
+    def __init__(self, purpose, timeout=None):
+        self.purpose = purpose
+        self.timeout = timeout
+
+    def get_timeout(self):
+        """
+        Seconds a token stays valid.
+        """
+        if self.timeout is not None:
+            return self.timeout
+        return settings.PASSWORD_RESET_TIMEOUT_DAYS * 24 * 60 * 60
+
+    def make_token(self, user):
+        return self._make_token_with_timestamp(user, int(self._now()))
+
+    def check_token_signature(self, uid, token):
+        """
+        Check everything that doesn't depend on the user's state. Doesn't touch the database.
+        """
+        try:
+            ts_b36, hashes = token.split('-')
+            timestamp = base36_to_int(ts_b36)
+        except ValueError:
+            return False
+        if len(hashes) != self.HASH_LENGTH * 2:
+            return False
+        if not constant_time_compare(hashes[:self.HASH_LENGTH], self._signature(uid, timestamp)):
+            return False
+        return 0 <= self._now() - timestamp <= self.get_timeout()
+
+    def check_token(self, user, token):
+        if not self.check_token_signature(user.pk, token):
+            return False
+        timestamp = base36_to_int(token.split('-')[0])
+        return constant_time_compare(self._make_token_with_timestamp(user, timestamp), token)
+
+    def get_user_state(self, user):
+        """
+        Values that change once the token has been used, so the token stops working.
+        """
+        login_timestamp = '' if user.last_login is None else user.last_login.replace(microsecond=0, tzinfo=None)
+        return six.text_type(user.password) + six.text_type(login_timestamp)
+
+    def _make_token_with_timestamp(self, user, timestamp):
+        state = self._hash('state', six.text_type(user.pk), six.text_type(timestamp), self.get_user_state(user))
+        return '%s-%s%s' % (int_to_base36(timestamp), self._signature(user.pk, timestamp), state)
+
+    def _signature(self, uid, timestamp):
+        return self._hash('signature', six.text_type(uid), six.text_type(timestamp))
+
+    def _hash(self, *values):
+        # Fixed length base36 so it fits the URL pattern in sky_visitor.urls
+        digest = salted_hmac('%s.%s' % (self.key_salt, self.purpose), '|'.join(values)).hexdigest()
+        return int_to_base36(int(digest, 16) % 36 ** self.HASH_LENGTH).rjust(self.HASH_LENGTH, '0')
+
+    def _now(self):
+        # Used for mocking in tests
+        return time.time()
+
+
+class InvitationTokenGenerator(SignedTokenGenerator):
+    """
+    Tokens for `InvitedUser`s. Only hashes the invitation's own columns, so checking a link is a single primary key
+    read, and expires after `SKY_INVITATION_TTL` seconds instead of `PASSWORD_RESET_TIMEOUT_DAYS`.
+    """
+    # Links made with django's default token generator before this one was used for invitations. Those have a 3
+    # character day count where these have a 6 character timestamp.
+    accept_legacy_tokens = True
+    legacy_token_generator = default_token_generator
+
+    def __init__(self, purpose='invitation', timeout=None):
+        super(InvitationTokenGenerator, self).__init__(purpose, timeout)
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return INVITATION_TTL
+
+    def get_user_state(self, invited_user):
+        return u'|'.join([invited_user.status, invited_user.email, invited_user.token_nonce])
+
+    def is_legacy_token(self, token):
+        return self.accept_legacy_tokens and len(token.split('-')[0]) < 6
+
+    def check_token_signature(self, uid, token):
+        if self.is_legacy_token(token):
+            return True
+        return super(InvitationTokenGenerator, self).check_token_signature(uid, token)
+
+    def check_token(self, invited_user, token):
+        if self.is_legacy_token(token):
+            return self.legacy_token_generator.check_token(invited_user, token)
+        return super(InvitationTokenGenerator, self).check_token(invited_user, token)
+
+
+invitation_token_generator = InvitationTokenGenerator()
@@ -0,0 +1,31 @@
+# Copyright 2013 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The same URLs as sky_visitor.urls, but the views that email tokens hand the email to the EmailOutbox instead of
+waiting on the mail server, whatever SKY_EMAIL_OUTBOX says. Run `manage.py sky_visitor_outbox_worker` to deliver them.
+"""
+from django.conf.urls import url
+from sky_visitor import urls
+from sky_visitor.views import ForgotPasswordView, InvitationStartView
+
+outbox_views = {
+    'forgot_password': ForgotPasswordView.as_view(use_email_outbox=True),
+    'invitation_start': InvitationStartView.as_view(use_email_outbox=True),
+}
+
+urlpatterns = [
+    url(pattern.regex.pattern, outbox_views[pattern.name], pattern.default_args, pattern.name)
+    if pattern.name in outbox_views else pattern
+    for pattern in urls.urlpatterns
+]
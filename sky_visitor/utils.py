@@ -1,14 +1,69 @@
 # -*- coding: utf-8 -*-
+import os
 import string
-import random
+import base64
 import hashlib
 import binascii
+import struct
+import threading
+import itertools
 import cPickle as pickle
 from Crypto.Cipher import AES
 
 from django.conf import settings
 
+
+class LRUCache(object):
+    """
+    A small thread safe mapping that forgets the least recently used entries once it holds more than `maxsize`.
+
+    Hits only stamp the entry with a counter, so they cost about as much as a dict lookup. The oldest tenth of the
+    entries is evicted at once when the cache overflows, so a full cache doesn't sort on every `set()`.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        entry[0] = next(self._clock)
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = [next(self._clock), value]
+            if len(self._data) > self.maxsize:
+                by_age = sorted(self._data, key=lambda k: self._data[k][0])
+                for k in by_age[:len(self._data) - self.maxsize + self.maxsize // 10]:
+                    del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 class Encryption(object):
+    """
+    AES-CBC with a key and IV derived from `key`.
+
+    Values are stored as `FORMAT_PREFIX` followed by the unpadded base64url ciphertext of a 2 byte big-endian length,
+    the UTF-8 encoded value and PKCS#7 padding. Values without the prefix are in the old format: the hex ciphertext of
+    the pickled value padded with spaces. Those can still be decrypted, see
+    `manage.py sky_visitor_migrate_enc_passwords` to convert them.
+    """
+    FORMAT_PREFIX = '2$'
+    BLOCK_SIZE = 16
+
+    # Derived keys by key string, shared by all instances in the process
+    key_cache = LRUCache(maxsize=1024)
 
     def __init__(self, key=None):
         self.key = key or settings.SECRET_KEY
@@ -16,22 +71,90 @@ class Encryption(object):
     def build_key(self, key):
         return hashlib.md5(key).hexdigest()
 
+    def get_key(self):
+        key = self.key_cache.get(self.key)
+        if key is None:
+            key = self.build_key(self.key)
+            self.key_cache.set(self.key, key)
+        return key
+
     def get_cipher_instance(self):
-        key = self.build_key(self.key)
+        # CBC cipher objects carry state between calls, so every message needs a fresh one
+        key = self.get_key()
         return AES.new(key, AES.MODE_CBC, key[:16])
 
+    @classmethod
+    def is_legacy(cls, enc_message):
+        return not enc_message.startswith(cls.FORMAT_PREFIX)
+
     def decrypt(self, enc_message):
-        ciphertext = binascii.a2b_hex(enc_message)
-        decryption_message = self.get_cipher_instance().decrypt(ciphertext).rstrip(' ')
-        return pickle.loads(decryption_message)
+        if self.is_legacy(enc_message):
+            ciphertext = binascii.a2b_hex(enc_message)
+            decryption_message = self.get_cipher_instance().decrypt(ciphertext).rstrip(' ')
+            return pickle.loads(decryption_message)
+
+        encoded = enc_message[len(self.FORMAT_PREFIX):]
+        ciphertext = base64.urlsafe_b64decode(str(encoded) + '=' * (-len(encoded) % 4))
+        padded = self.get_cipher_instance().decrypt(ciphertext)
+        padding = ord(padded[-1])
+        if not 1 <= padding <= self.BLOCK_SIZE or padded[-padding:] != padded[-1] * padding:
+            raise ValueError("Invalid padding")
+        payload = padded[:-padding]
+        length, = struct.unpack('>H', payload[:2])
+        if length != len(payload) - 2:
+            raise ValueError("Invalid payload length")
+        return payload[2:].decode('utf-8')
 
     def encrypt(self, message):
-        pickled = pickle.dumps(message)
-        ciphertext = self.get_cipher_instance().encrypt(pickled + (' ' * (16 - (len(pickled) % 16))))
-        enc_message = binascii.b2a_hex(ciphertext)
-        return enc_message
+        encoded = message.encode('utf-8') if isinstance(message, unicode) else message
+        payload = struct.pack('>H', len(encoded)) + encoded
+        padding = self.BLOCK_SIZE - len(payload) % self.BLOCK_SIZE
+        ciphertext = self.get_cipher_instance().encrypt(payload + chr(padding) * padding)
+        return self.FORMAT_PREFIX + base64.urlsafe_b64encode(ciphertext).rstrip('=')
+
+    def decrypt_many(self, enc_messages):
+        return [self.decrypt(enc_message) for enc_message in enc_messages]
+
+    def encrypt_many(self, messages):
+        return [self.encrypt(message) for message in messages]
+
+
+def make_passwords(n, length=8, alphabet=string.ascii_letters):
+    """
+    Generate `n` random passwords of `length` characters from `alphabet` (at most 256 single byte characters).
+
+    Random bytes come from `os.urandom`, fetched for a whole batch at a time. A byte maps to
+    `alphabet[byte % len(alphabet)]`, and bytes past the last whole multiple of `len(alphabet)` are thrown away so
+    every character is equally likely. Both steps are done for the whole buffer in one `str.translate()` call.
+    """
+    alphabet = str(alphabet)
+    size = len(alphabet)
+    if not 0 < size <= 256:
+        raise ValueError("The alphabet must have between 1 and 256 characters.")
+    limit = 256 - 256 % size
+    table = ''.join(alphabet[b % size] for b in xrange(256))
+    rejected = ''.join(chr(b) for b in xrange(limit, 256))
+
+    pool = ''
+    pos = 0
+    for i in xrange(n):
+        while len(pool) - pos < length:
+            # Enough for the remaining passwords on average, plus a little for rejected bytes
+            wanted = ((n - i) * length - (len(pool) - pos)) * 256 // limit + 16
+            pool = pool[pos:] + os.urandom(min(max(wanted, 64), 1 << 16)).translate(table, rejected)
+            pos = 0
+        yield pool[pos:pos + length]
+        pos += length
 
 
 def make_password(length=8, chars=string.ascii_letters):
-    return ''.join(random.choice(chars) for _ in xrange(length))
+    return next(make_passwords(1, length, chars))
+
+
+def make_token_nonce():
+    return make_password(12, string.ascii_letters + string.digits)
+
 
+def chunked(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
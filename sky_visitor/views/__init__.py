@@ -14,7 +14,6 @@
 from django.contrib import auth
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
 
 from django.http import HttpResponseRedirect
@@ -33,11 +32,16 @@ try:
 except AttributeError:
     atomic = transaction.commit_on_success
 
+from sky_visitor.cache import get_cache, make_key, invalidate_cached_user
+from sky_visitor.config import FORGOT_PASSWORD_COALESCE_WINDOW, LOGIN_TEST_COOKIE
 from sky_visitor.models import InvitedUser
+from sky_visitor.shortcuts import get_users_by_email
+from sky_visitor.tokens import invitation_token_generator
 from sky_visitor.backends import auto_login
 from sky_visitor.forms import RegisterForm, LoginForm, PasswordResetForm, SetPasswordForm, PasswordChangeForm, \
     InvitationStartForm, InvitationCompleteForm
-from sky_visitor.views.mixins import SendTokenEmailMixin, TokenValidateMixin, LoginRequiredMixin
+from sky_visitor.views.mixins import SendTokenEmailMixin, TokenValidateMixin, LoginRequiredMixin, RateLimitMixin, \
+    HashingUnavailableMixin, PageCacheMixin, StaticPageMixin
 
 
 def try_get_or_post_key(request, key, default=None):
@@ -49,7 +53,7 @@ def try_get_or_post_key(request, key, default=None):
     return default
 
 
-class RegisterView(CreateView):
+class RegisterView(HashingUnavailableMixin, PageCacheMixin, CreateView):
     model = auth.get_user_model()
     form_class = RegisterForm
     template_name = 'sky_visitor/register.html'
@@ -69,7 +73,7 @@ class RegisterView(CreateView):
 
 
 # Originally from: https://github.com/stefanfoulis/django-class-based-auth-views/blob/develop/class_based_auth_views/views.py
-class LoginView(FormView):
+class LoginView(RateLimitMixin, HashingUnavailableMixin, PageCacheMixin, FormView):
     """
     This is a class based version of django.contrib.auth.views.login.
 
@@ -86,6 +90,9 @@ class LoginView(FormView):
     success_url_overrides_redirect_field = False
     template_name = 'sky_visitor/login.html'
     form_class = LoginForm
+    # 'session', 'signed' or None, see SKY_LOGIN_TEST_COOKIE. Only 'session' saves a session before the user logs in.
+    test_cookie = LOGIN_TEST_COOKIE
+    test_cookie_name = 'sky_visitor_testcookie'
 
     @method_decorator(csrf_protect)
     @method_decorator(never_cache)
@@ -116,20 +123,39 @@ class LoginView(FormView):
         return redirect_to
 
     def set_test_cookie(self):
-        self.request.session.set_test_cookie()
+        if self.test_cookie == 'session':
+            self.request.session.set_test_cookie()
+        elif self.test_cookie == 'signed':
+            self.test_cookie_action = 'set'
 
     def check_and_delete_test_cookie(self):
-        if self.request.session.test_cookie_worked():
-            self.request.session.delete_test_cookie()
-            return True
+        if self.test_cookie == 'session':
+            if self.request.session.test_cookie_worked():
+                self.request.session.delete_test_cookie()
+                return True
+        elif self.test_cookie == 'signed':
+            if self.request.get_signed_cookie(self.test_cookie_name, default=None, salt=self.test_cookie_name):
+                self.test_cookie_action = 'delete'
+                return True
         return False
 
+    def update_test_cookie(self, response):
+        """
+        Sets or deletes the signed test cookie on the response, for `test_cookie = 'signed'`.
+        """
+        action = getattr(self, 'test_cookie_action', None)
+        if action == 'set':
+            response.set_signed_cookie(self.test_cookie_name, 'worked', salt=self.test_cookie_name, httponly=True)
+        elif action == 'delete':
+            response.delete_cookie(self.test_cookie_name)
+        return response
+
     def get(self, request, *args, **kwargs):
         """
         Same as django.views.generic.edit.ProcessFormView.get(), but adds test cookie stuff
         """
         self.set_test_cookie()
-        return super(LoginView, self).get(request, *args, **kwargs)
+        return self.update_test_cookie(super(LoginView, self).get(request, *args, **kwargs))
 
     def post(self, request, *args, **kwargs):
         """
@@ -139,10 +165,10 @@ class LoginView(FormView):
         form = self.get_form(form_class)
         if form.is_valid():
             self.check_and_delete_test_cookie()
-            return self.form_valid(form)
+            return self.update_test_cookie(self.form_valid(form))
         else:
             self.set_test_cookie()
-            return self.form_invalid(form)
+            return self.update_test_cookie(self.form_invalid(form))
 
 
 class LogoutView(RedirectView):
@@ -177,26 +203,45 @@ class LogoutView(RedirectView):
         return redirect_to
 
 
-class ForgotPasswordView(SendTokenEmailMixin, FormView):
+class ForgotPasswordView(RateLimitMixin, SendTokenEmailMixin, PageCacheMixin, FormView):
     form_class = PasswordResetForm
     template_name = 'sky_visitor/forgot_password_start.html'
     email_template_name = 'sky_visitor/email/visitor-forgot-password.html'
     token_view_name = 'reset_password'
     subject = "Password reset for testserver"
+    rate_limit_field = 'email'
+    send_failed_message = _("We couldn't send the password reset email. Please try again in a few minutes.")
+    # Seconds during which repeat submits for the same email address don't send another email
+    coalesce_window = FORGOT_PASSWORD_COALESCE_WINDOW
+
+    def get_coalesce_key(self, email):
+        return make_key('forgot_password', email.strip().lower())
 
     def form_valid(self, form):
-        # Copied behavior from django.contrib.auth.forms.PasswordResetForm
-        UserModel = get_user_model()
         email = form.cleaned_data["email"]
-        active_users = UserModel._default_manager.filter(
-            email__iexact=email, is_active=True)
-        for user in active_users:
+        coalesce_key = self.get_coalesce_key(email)
+        if self.coalesce_window and not get_cache().add(coalesce_key, True, self.coalesce_window):
+            # The email from an earlier submit is already on its way
+            return super(ForgotPasswordView, self).form_valid(form)
+
+        try:
+            # Copied behavior from django.contrib.auth.forms.PasswordResetForm
+            active_users = get_users_by_email(email, is_active=True)
             # Make sure that no email is sent to a user that actually has
             # a password marked as unusable
-            if not user.has_usable_password():
-                continue
-
-            self.send_email(user)
+            results = self.send_emails([user for user in active_users if user.has_usable_password()])
+        except Exception:
+            # Let the user try again right away
+            if self.coalesce_window:
+                get_cache().delete(coalesce_key)
+            raise
+
+        if not all(sent for email, sent, error in results):
+            # Errors are logged by the sender. Don't send the user off to wait for an email that isn't coming.
+            if self.coalesce_window:
+                get_cache().delete(coalesce_key)
+            messages.error(self.request, self.send_failed_message, fail_silently=True)
+            return self.render_to_response(self.get_context_data(form=form))
 
         return super(ForgotPasswordView, self).form_valid(form)  # Do redirect
 
@@ -204,15 +249,17 @@ class ForgotPasswordView(SendTokenEmailMixin, FormView):
         return reverse('forgot_password_check_email')
 
 
-class ForgotPasswordCheckEmailView(TemplateView):
+class ForgotPasswordCheckEmailView(StaticPageMixin, TemplateView):
     template_name = 'sky_visitor/forgot_password_check_email.html'
 
 
-class ResetPasswordView(TokenValidateMixin, FormView):
+class ResetPasswordView(HashingUnavailableMixin, TokenValidateMixin, FormView):
     form_class = SetPasswordForm
     template_name = 'sky_visitor/reset_password.html'
     invalid_token_message = _("Invalid reset password link. Please reset your password again.")
     auto_login_on_success = True
+    # What default_token_generator hashes. The form only changes the password.
+    token_user_fields = ('password', 'last_login')
     success_message = _("Succesfully reset password.")
 
     def get_form_kwargs(self):
@@ -229,6 +276,7 @@ class ResetPasswordView(TokenValidateMixin, FormView):
     def form_valid(self, form):
         if self.is_token_valid:
             form.save()
+            invalidate_cached_user(self.token_user.pk)
             messages.success(self.request, self.success_message, fail_silently=True)
             auto_login(self.request, self.token_user)
         return super(ResetPasswordView, self).form_valid(form)
@@ -238,7 +286,7 @@ class ResetPasswordView(TokenValidateMixin, FormView):
             return resolve_url(settings.LOGIN_REDIRECT_URL)
 
 
-class ChangePasswordView(LoginRequiredMixin, FormView):
+class ChangePasswordView(LoginRequiredMixin, HashingUnavailableMixin, FormView):
     form_class = PasswordChangeForm
     success_message = _("Succesfully changed password.")
     template_name = 'sky_visitor/change_password.html'
@@ -250,6 +298,7 @@ class ChangePasswordView(LoginRequiredMixin, FormView):
 
     def form_valid(self, form):
         form.save()
+        invalidate_cached_user(self.request.user.pk)
         messages.success(self.request, self.success_message, fail_silently=True)
         return super(ChangePasswordView, self).form_valid(form)
 
@@ -261,13 +310,14 @@ class ChangePasswordView(LoginRequiredMixin, FormView):
             return super(ChangePasswordView, self).get_success_url()
 
 
-class InvitationStartView(SendTokenEmailMixin, CreateView):
+class InvitationStartView(SendTokenEmailMixin, PageCacheMixin, CreateView):
     form_class = InvitationStartForm
     template_name = 'sky_visitor/invitation_start.html'
     email_template_name = 'sky_visitor/email/invitation_complete.html'
 
     success_message = _("Invitation successfully delivered.")
     token_view_name = 'invitation_complete'
+    token_generator = invitation_token_generator
     subject = "Invitation to Create Account at testserver"
 
     def get_user_object(self):
@@ -291,7 +341,7 @@ class InvitationStartView(SendTokenEmailMixin, CreateView):
         return self.request.path
 
 
-class InvitationCompleteView(TokenValidateMixin, CreateView):
+class InvitationCompleteView(HashingUnavailableMixin, TokenValidateMixin, CreateView):
     """
     Invitations create an InviteUser. Once an invitation is completed, a standard user object is created.
 
@@ -304,12 +354,13 @@ class InvitationCompleteView(TokenValidateMixin, CreateView):
     invalid_token_message = _(
         "This one-time use invitation URL has already been used. This means you have likely already created an account. Please try to login or use the forgot password form.")
     success_message = _("Account successfully created.")
+    token_generator = invitation_token_generator
 
     # Since this is an UpdateView, the default success_url will be the user's get_absolute_url(). Override if you'd like different behavior
 
     def get_user_model_class(self):
         """
-        Used for token validation. We're faking a real user with the InvitedUser so we can use django core's token validation code.
+        Used for token validation. Tokens are checked against the InvitedUser, see `InvitationTokenGenerator`.
         """
         return InvitedUser
 
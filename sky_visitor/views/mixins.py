@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
@@ -19,15 +20,31 @@ from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.middleware.csrf import get_token
 from django.shortcuts import resolve_url
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.http import base36_to_int, int_to_base36
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language, ugettext_lazy as _
 
 
-from ..config import TEMPLATE_EMAIL_SENDER_CLASS
+from ..cache import get_cache, make_key, incr, get_counters, count_recent
+from ..config import TEMPLATE_EMAIL_SENDER_CLASS, EMAIL_OUTBOX, INVALID_TOKEN_CACHE_TIMEOUT, RATE_LIMIT_PER_IP, \
+    RATE_LIMIT_PER_USER, PAGE_CACHE_TIMEOUT, PAGE_CACHE_VERSION
+from .. import last_login
+from ..hashing import HashingUnavailable
+from ..models import EmailOutbox
+
+
+INVALID_TOKEN_CACHE_HITS = 'sky_visitor.invalid_token.hits'
+INVALID_TOKEN_CACHE_MISSES = 'sky_visitor.invalid_token.misses'
+
+
+def get_invalid_token_cache_stats():
+    counters = get_counters(INVALID_TOKEN_CACHE_HITS, INVALID_TOKEN_CACHE_MISSES)
+    return {'hits': counters[INVALID_TOKEN_CACHE_HITS], 'misses': counters[INVALID_TOKEN_CACHE_MISSES]}
 
 
 class LoginRequiredMixin(object):
@@ -38,12 +55,153 @@ class LoginRequiredMixin(object):
         return super(LoginRequiredMixin, self).dispatch(*args, **kwargs)
 
 
+class RateLimitMixin(object):
+    """
+    Turns away POSTs over the limit before the form is validated, so they don't cost a password hash or a query.
+
+    Limits are `(requests, seconds)` tuples, counted in the cache per client IP and per value of `rate_limit_field`.
+    """
+    rate_limit_per_ip = RATE_LIMIT_PER_IP
+    rate_limit_per_user = RATE_LIMIT_PER_USER
+    rate_limit_field = 'username'
+    rate_limited_message = _("Too many attempts. Please wait a few minutes and try again.")
+
+    def get_client_ip(self):
+        """
+        Override if the site is behind a proxy that sets the real client IP in a header.
+        """
+        return self.request.META.get('REMOTE_ADDR', '')
+
+    def get_rate_limits(self):
+        limits = []
+        if self.rate_limit_per_ip:
+            limits.append(('ip', self.get_client_ip(), self.rate_limit_per_ip))
+        user = self.request.POST.get(self.rate_limit_field, '').strip().lower()
+        if self.rate_limit_per_user and user:
+            limits.append(('user', user, self.rate_limit_per_user))
+        return limits
+
+    def is_rate_limited(self):
+        limited = False
+        for kind, value, (requests, seconds) in self.get_rate_limits():
+            key = make_key('rate_limit', self.__class__.__name__, kind, value)
+            if count_recent(key, seconds) > requests:
+                limited = True
+        return limited
+
+    def rate_limited(self, request, *args, **kwargs):
+        return HttpResponse(self.rate_limited_message, status=429, content_type='text/plain; charset=utf-8')
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method == 'POST' and self.is_rate_limited():
+            return self.rate_limited(request, *args, **kwargs)
+        return super(RateLimitMixin, self).dispatch(request, *args, **kwargs)
+
+
+class HashingUnavailableMixin(object):
+    """
+    Answers with a 503 when the password hashing pool is full or too slow (see sky_visitor.hashing).
+    """
+    hashing_unavailable_message = _("We're unusually busy. Please try again in a moment.")
+
+    def hashing_unavailable(self, request, *args, **kwargs):
+        response = HttpResponse(self.hashing_unavailable_message, status=503, content_type='text/plain; charset=utf-8')
+        response['Retry-After'] = '5'
+        return response
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(HashingUnavailableMixin, self).dispatch(request, *args, **kwargs)
+        except HashingUnavailable:
+            return self.hashing_unavailable(request, *args, **kwargs)
+
+
+def is_cacheable_request(request):
+    """
+    Whether the page for `request` is the same for every anonymous visitor, so that it can be cached.
+    """
+    # Always render with DEBUG, so template changes show up right away
+    return not settings.DEBUG and request.method in ('GET', 'HEAD') and not request.user.is_authenticated() and \
+        not len(messages.get_messages(request))
+
+
+class PageCacheMixin(object):
+    """
+    Caches the rendered page of GET requests from anonymous visitors for `page_cache_timeout` seconds. The page is
+    stored with a placeholder for the CSRF token, which every request gets its own of when it is served. Requests
+    with pending messages are rendered as usual, since where messages show up is up to the project's templates.
+    """
+    page_cache_timeout = PAGE_CACHE_TIMEOUT
+    csrf_placeholder = 'SKY-VISITOR-CSRF-TOKEN'
+
+    def can_cache_page(self):
+        # Pages with a query string (a `next` URL or anything made up) aren't cached, so clients can't fill the cache
+        return bool(self.page_cache_timeout) and is_cacheable_request(self.request) and not self.request.GET
+
+    def get_page_cache_key(self):
+        request = self.request
+        return make_key('page', self.__class__.__module__, self.__class__.__name__, request.get_host(), request.path,
+                        get_language() or '', PAGE_CACHE_VERSION)
+
+    def render_to_response(self, context, **response_kwargs):
+        if not self.can_cache_page():
+            return super(PageCacheMixin, self).render_to_response(context, **response_kwargs)
+        cache = get_cache()
+        key = self.get_page_cache_key()
+        content = cache.get(key)
+        if content is None:
+            context['csrf_token'] = self.csrf_placeholder
+            response = super(PageCacheMixin, self).render_to_response(context, **response_kwargs)
+            content = response.render().content
+            if response.status_code != 200:
+                return response
+            cache.set(key, content, self.page_cache_timeout)
+        else:
+            response_kwargs.setdefault('content_type', self.content_type)
+            response = HttpResponse(**response_kwargs)
+        response.content = content.replace(self.csrf_placeholder, str(get_token(self.request)))
+        return response
+
+
+class StaticPageMixin(object):
+    """
+    For pages without a form, which don't need a CSRF token: adds an ETag and lets browsers and proxies cache the
+    page for `page_cache_timeout` seconds.
+    """
+    page_cache_timeout = PAGE_CACHE_TIMEOUT
+
+    def can_cache_page(self):
+        return bool(self.page_cache_timeout) and is_cacheable_request(self.request)
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super(StaticPageMixin, self).render_to_response(context, **response_kwargs)
+        if not self.can_cache_page():
+            return response
+        response.render()
+        # A template that used the CSRF token makes the response set a cookie, which must not be shared
+        if response.status_code != 200 or self.request.META.get('CSRF_COOKIE_USED'):
+            return response
+        etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+        if self.request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=self.page_cache_timeout)
+        return response
+
+
 class SendTokenEmailMixin(object):
     email_template_name = None
     subject = None
 
     token_view_name = None
+    # Must match the token generator of the view at token_view_name
+    token_generator = default_token_generator
+
+    # Queue the email in the EmailOutbox instead of sending it during the request
+    use_email_outbox = EMAIL_OUTBOX
 
+    def get_token_generator(self):
+        return self.token_generator
 
     def get_email_template_name(self):
         return self.email_template_name
@@ -57,7 +215,8 @@ class SendTokenEmailMixin(object):
             raise ImproperlyConfigured("No token_view_name defined.")
 
         site = Site.objects.get_current()
-        token = default_token_generator.make_token(user)
+        last_login.flush_user(user)
+        token = self.get_token_generator().make_token(user)
         uidb36 = int_to_base36(user.id)
 
         static_url = settings.STATIC_URL
@@ -80,10 +239,10 @@ class SendTokenEmailMixin(object):
             'static_url': static_url,
         }
 
-    def send_email(self, user, **kwargs):
+    def get_email_sender_kwargs(self, user, **kwargs):
         to_address = getattr(user, 'email', None)
         if not to_address:
-            return False
+            return None
 
         email_template_name = kwargs.get('template_name', self.get_email_template_name())
 
@@ -97,8 +256,46 @@ class SendTokenEmailMixin(object):
         context = self.get_email_context_data(user, **kwargs)
 
         sender_kwargs.update(kwargs)
-        return TEMPLATE_EMAIL_SENDER_CLASS().send(template_name=email_template_name,
-                        to_address=to_address, context=context, **sender_kwargs)
+        sender_kwargs.update({
+            'template_name': email_template_name,
+            'to_address': to_address,
+            'context': context,
+        })
+        return sender_kwargs
+
+    def get_email_sender(self):
+        if self.use_email_outbox and not TEMPLATE_EMAIL_SENDER_CLASS.can_build_messages():
+            raise ImproperlyConfigured("%s queues emails in the outbox, which needs a SKY_TEMPLATE_EMAIL_SENDER that "
+                                       "implements build_message()." % self.__class__.__name__)
+        return TEMPLATE_EMAIL_SENDER_CLASS()
+
+    def send_email(self, user, **kwargs):
+        sender_kwargs = self.get_email_sender_kwargs(user, **kwargs)
+        if sender_kwargs is None:
+            return False
+
+        sender = self.get_email_sender()
+        if self.use_email_outbox:
+            return EmailOutbox.objects.enqueue(sender.build_message(**sender_kwargs))
+        return sender.send(**sender_kwargs)
+
+    def send_emails(self, users, **kwargs):
+        """
+        Send the token email to several users over one mail server connection.
+
+        Returns a list of `(email, sent, error)` tuples, see `BaseTemplateSender.send_many()`.
+        """
+        messages = [sender_kwargs for sender_kwargs in (self.get_email_sender_kwargs(user, **kwargs) for user in users)
+                    if sender_kwargs is not None]
+        if not messages:
+            return []
+
+        sender = self.get_email_sender()
+        if self.use_email_outbox:
+            for sender_kwargs in messages:
+                EmailOutbox.objects.enqueue(sender.build_message(**sender_kwargs))
+            return [(sender_kwargs['to_address'], True, None) for sender_kwargs in messages]
+        return sender.send_many(messages)
 
 
 class TokenValidateMixin(object):
@@ -110,12 +307,30 @@ class TokenValidateMixin(object):
     is_token_valid = False
     invalid_token_message = _("This one-time use URL has already been used. Try to login or use the forgot password form.")
 
+    # Limit the columns loaded for `token_user` to these fields (plus the primary key). Must include everything the
+    # token generator hashes, anything else is loaded with an extra query when it's accessed. None loads everything.
+    token_user_fields = None
+    # Relations joined into the `token_user` query, for token generators that hash related fields
+    token_user_select_related = None
+    # Seconds to remember links that turned out to be invalid, so browser history, link scanners and retries hitting
+    # them again are redirected without checking the token. 0 turns it off.
+    invalid_token_cache_timeout = INVALID_TOKEN_CACHE_TIMEOUT
+
     def get_token_generator(self):
         return self.token_generator
 
     def get_user_model_class(self):
         return get_user_model()
 
+    def get_token_user_queryset(self):
+        UserModel = self.get_user_model_class()
+        queryset = UserModel._default_manager.all()
+        if self.token_user_select_related:
+            queryset = queryset.select_related(*self.token_user_select_related)
+        if self.token_user_fields:
+            queryset = queryset.only(*self.token_user_fields)
+        return queryset
+
     @cached_property
     def token_user(self):
         uidb36 = self.kwargs.get('uidb36')
@@ -124,16 +339,50 @@ class TokenValidateMixin(object):
         if not hasattr(self, '_token_user'):
             try:
                 uid_int = base36_to_int(uidb36)
-                self._token_user = UserModel._default_manager.get(id=uid_int)
+                self._token_user = self.get_token_user_queryset().get(pk=uid_int)
             except (ValueError, OverflowError, UserModel.DoesNotExist):
                 self._token_user = None
         return self._token_user
 
+    def check_token_signature(self, token):
+        """
+        Let token generators that can tell a link is bad from the URL alone (see `SignedTokenGenerator`) reject it
+        before the user is loaded.
+        """
+        check_token_signature = getattr(self.get_token_generator(), 'check_token_signature', None)
+        if check_token_signature is None:
+            return True
+        try:
+            uid_int = base36_to_int(self.kwargs['uidb36'])
+        except (ValueError, OverflowError):
+            return False
+        return check_token_signature(uid_int, token)
+
+    def get_invalid_token_cache_key(self):
+        return make_key('invalid_token', self.request.path)
+
+    def is_known_invalid_token(self):
+        if not self.invalid_token_cache_timeout:
+            return False
+        known_invalid = get_cache().get(self.get_invalid_token_cache_key()) is not None
+        incr(INVALID_TOKEN_CACHE_HITS if known_invalid else INVALID_TOKEN_CACHE_MISSES)
+        return known_invalid
+
+    def remember_invalid_token(self):
+        if self.invalid_token_cache_timeout:
+            # add() so a burst of hits on the same link only writes once
+            get_cache().add(self.get_invalid_token_cache_key(), True, self.invalid_token_cache_timeout)
+
     def dispatch(self, request, *args, **kwargs):
         token = kwargs['token']
         assert token is not None  # checked by URLconf
-        self.is_token_valid = (self.token_user is not None and self.get_token_generator().check_token(self.token_user, token))
+        if self.is_known_invalid_token():
+            self.is_token_valid = False
+            return self.token_invalid(request, *args, **kwargs)
+        self.is_token_valid = (self.check_token_signature(token) and self.token_user is not None and
+                               self.get_token_generator().check_token(self.token_user, token))
         if not self.is_token_valid:
+            self.remember_invalid_token()
             return self.token_invalid(request, *args, **kwargs)
         return super(TokenValidateMixin, self).dispatch(request, *args, **kwargs)
 